@@ -0,0 +1,103 @@
+import asyncio
+import aiohttp
+
+from slots import get_base_url
+
+EWMA_ALPHA = 0.3 # Weight of the latest latency in the moving average
+DEFAULT_LATENCY = 1.0 # Seconds assumed for a backend that never answered yet
+STICKY_TOLERANCE = 3.0 # A chat leaves its backend when it scores this much worse than the best one
+HEALTH_CHECK_INTERVAL = 15 # Seconds between two health checks of the unhealthy backends
+
+class Backend:
+    """One inference endpoint of the pool, with its latency and load.
+    """
+    def __init__(self, model, config):
+        self.model = {**model, **config}
+        self.api_url = self.model['api_url']
+        self.latency = None
+        self.in_flight = 0
+        self.healthy = True
+
+    def score(self):
+        return (self.latency or DEFAULT_LATENCY) * (self.in_flight + 1)
+
+    def succeeded(self, latency):
+        self.healthy = True
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency = EWMA_ALPHA * latency + (1 - EWMA_ALPHA) * self.latency
+
+    def failed(self):
+        if self.healthy:
+            print(f"Backend {self.api_url} is unhealthy")
+        self.healthy = False
+
+    async def check(self, session):
+        """Probes the backend, the llama.cpp /health endpoint or a bare GET.
+        """
+        url = get_base_url(self.api_url)
+        if self.model['engine'] == "llamacpp":
+            url = f"{url}/health"
+        try:
+            async with session.get(url, timeout=aiohttp.ClientTimeout(total=5)) as response:
+                if response.status < 500:
+                    if not self.healthy:
+                        print(f"Backend {self.api_url} is healthy again")
+                    self.healthy = True
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            pass
+
+class BackendPool:
+    """Routes the requests of the chats between the backends of a model.
+
+    `model['backends']` lists overrides of the model settings, usually
+    `api_url` and `engine`, one per backend. Chats stick to the backend they
+    last used so its prompt cache stays warm, unless it is unhealthy or
+    scores much worse than the best one. The score is a moving average of the
+    latency multiplied by the number of requests in flight.
+    """
+    def __init__(self, model):
+        configs = model.get('backends') or [{}]
+        self.backends = [Backend(model, config) for config in configs]
+        self.sticky = {} # chat_id -> Backend
+        self.health_task = None
+
+    def route(self, chat_id, exclude=()):
+        """Picks the backend for a request of the chat, None if all were excluded.
+        """
+        candidates = [b for b in self.backends if b not in exclude]
+        if not candidates:
+            return None
+        healthy = [b for b in candidates if b.healthy] or candidates
+        best = min(healthy, key=lambda b: b.score())
+
+        backend = self.sticky.get(chat_id)
+        if backend not in healthy or backend.score() > STICKY_TOLERANCE * best.score():
+            backend = best
+        self.sticky[chat_id] = backend
+        return backend
+
+    def start(self, session):
+        if self.health_task is None and len(self.backends) > 1:
+            self.health_task = asyncio.create_task(self.check_health(session))
+
+    async def check_health(self, session):
+        while True:
+            await asyncio.sleep(HEALTH_CHECK_INTERVAL)
+            await asyncio.gather(*[
+                backend.check(session) for backend in self.backends if not backend.healthy
+            ])
+
+    async def close(self):
+        if self.health_task is not None:
+            self.health_task.cancel()
+            self.health_task = None
+
+BACKEND_POOLS = {} # model name -> BackendPool
+
+def get_backend_pool(model):
+    pool = BACKEND_POOLS.get(model['name'])
+    if pool is None:
+        pool = BACKEND_POOLS[model['name']] = BackendPool(model)
+    return pool
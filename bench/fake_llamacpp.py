@@ -0,0 +1,118 @@
+"""A local stand-in for the llama.cpp server, with simulated prefill and decode times.
+
+Each slot remembers the last prompt it processed. A request only pays prefill
+for the part of its prompt after the prefix it shares with that cached prompt,
+and a slot runs one request at a time, like the real server.
+"""
+import os
+import json
+import time
+import asyncio
+from aiohttp import web
+
+CHARS_PER_TOKEN = 2.7
+
+class Slot:
+    def __init__(self, id):
+        self.id = id
+        self.prompt = ""
+        self.lock = asyncio.Lock()
+        self.used_at = 0
+
+class FakeLlamaCpp:
+    def __init__(self, n_slots=4, prefill_ms=0.2, decode_ms=20, reply_tokens=24):
+        self.slots = [Slot(i) for i in range(n_slots)]
+        self.prefill = prefill_ms / 1000 # seconds per prompt token not in the cache
+        self.decode = decode_ms / 1000 # seconds per generated token
+        self.reply_tokens = reply_tokens
+        self.requests = 0
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+
+    def app(self):
+        app = web.Application()
+        app.router.add_post("/completion", self.completion)
+        app.router.add_post("/tokenize", self.tokenize)
+        app.router.add_get("/slots", self.get_slots)
+        app.router.add_get("/props", self.props)
+        app.router.add_get("/health", self.health)
+        return app
+
+    def pick_slot(self, id_slot):
+        if 0 <= id_slot < len(self.slots):
+            return self.slots[id_slot]
+        idle = [slot for slot in self.slots if not slot.lock.locked()] or self.slots
+        return min(idle, key=lambda slot: slot.used_at)
+
+    async def completion(self, request):
+        params = await request.json()
+        self.requests += 1
+        slot = self.pick_slot(params.get('id_slot', -1))
+        n_predict = min(params.get('n_predict', self.reply_tokens), self.reply_tokens)
+
+        async with slot.lock:
+            prompt = params['prompt']
+            cached_chars = 0
+            if params.get('cache_prompt'):
+                cached_chars = len(os.path.commonprefix([prompt, slot.prompt]))
+            prompt_tokens = int(len(prompt) / CHARS_PER_TOKEN)
+            cached = int(cached_chars / CHARS_PER_TOKEN)
+            prompt_n = prompt_tokens - cached
+            self.prompt_tokens += prompt_tokens
+            self.cached_tokens += cached
+
+            started = time.monotonic()
+            await asyncio.sleep(prompt_n * self.prefill)
+            prefill_done = time.monotonic()
+
+            final = {
+                "content": "",
+                "stop": True,
+                "id_slot": slot.id,
+                "stopped_eos": n_predict == self.reply_tokens,
+                "stopped_word": False,
+                "stopped_limit": n_predict < self.reply_tokens,
+                "tokens_evaluated": prompt_tokens,
+                "tokens_cached": cached,
+            }
+            tokens = [f" word{i}" for i in range(n_predict)]
+
+            if params.get('stream'):
+                response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+                await response.prepare(request)
+                for token in tokens:
+                    await asyncio.sleep(self.decode)
+                    await response.write(f"data: {json.dumps({'content': token, 'stop': False})}\n\n".encode())
+            else:
+                await asyncio.sleep(self.decode * n_predict)
+                final['content'] = "".join(tokens)
+
+            final['timings'] = {
+                "prompt_n": prompt_n,
+                "prompt_ms": (prefill_done - started) * 1000,
+                "predicted_n": n_predict,
+                "predicted_ms": (time.monotonic() - prefill_done) * 1000,
+            }
+            slot.prompt = prompt + "".join(tokens)
+            slot.used_at = time.monotonic()
+
+        if params.get('stream'):
+            await response.write(f"data: {json.dumps(final)}\n\n".encode())
+            await response.write_eof()
+            return response
+        return web.json_response(final)
+
+    async def tokenize(self, request):
+        params = await request.json()
+        return web.json_response({"tokens": [0] * int(len(params['content']) / CHARS_PER_TOKEN)})
+
+    async def get_slots(self, request):
+        return web.json_response([
+            {"id": slot.id, "is_processing": slot.lock.locked()} for slot in self.slots
+        ])
+
+    async def props(self, request):
+        return web.json_response({"total_slots": len(self.slots)})
+
+    async def health(self, request):
+        return web.json_response({"status": "ok"})
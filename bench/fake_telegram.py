@@ -0,0 +1,91 @@
+"""A local stand-in for the Telegram Bot API, enough for the calls the bot makes.
+
+Point `telebot.asyncio_helper.API_URL` at it. It records when the bot first
+replies to each message so the benchmark can compute time to first reply.
+"""
+import json
+import time
+import asyncio
+from urllib.parse import parse_qsl
+from aiohttp import web
+
+BOT_USER = {"id": 1000, "is_bot": True, "first_name": "Liberchat", "username": "liberchat_bot"}
+
+class FakeTelegram:
+    def __init__(self, api_delay_ms=0):
+        self.api_delay = api_delay_ms / 1000
+        self.next_message_id = 10_000_000
+        self.first_replies = {} # (chat_id, replied message_id) -> monotonic time of the reply
+        self.calls = {} # method -> number of calls
+        self.messages = {} # (chat_id, message_id) -> text
+
+    def app(self):
+        app = web.Application()
+        app.router.add_route("*", "/bot{token}/{method}", self.handle)
+        return app
+
+    def chat_info(self, chat_id):
+        if chat_id > 0:
+            return {"id": chat_id, "type": "private", "username": f"user{chat_id}", "first_name": "User", "last_name": str(chat_id)}
+        return {"id": chat_id, "type": "supergroup", "title": f"Group {-chat_id}", "description": "A synthetic benchmark group"}
+
+    async def handle(self, request):
+        method = request.match_info['method']
+        self.calls[method] = self.calls.get(method, 0) + 1
+        params = await read_params(request)
+        if self.api_delay:
+            await asyncio.sleep(self.api_delay)
+
+        if method == "getMe":
+            result = BOT_USER
+        elif method in ("setMyCommands", "deleteWebhook", "setWebhook"):
+            result = True
+        elif method == "getChat":
+            result = self.chat_info(int(params['chat_id']))
+        elif method == "getUpdates":
+            result = []
+        elif method == "sendMessage":
+            result = self.send_message(params)
+        elif method == "editMessageText":
+            chat_id, message_id = int(params['chat_id']), int(params['message_id'])
+            self.messages[(chat_id, message_id)] = params['text']
+            result = self.message(chat_id, message_id, params['text'])
+        else:
+            return web.json_response({"ok": False, "error_code": 404, "description": f"Not Found: {method}"}, status=404)
+        return web.json_response({"ok": True, "result": result})
+
+    def send_message(self, params):
+        chat_id = int(params['chat_id'])
+        self.next_message_id += 1
+        message_id = self.next_message_id
+        self.messages[(chat_id, message_id)] = params['text']
+
+        reply_to = None
+        if 'reply_parameters' in params:
+            reply_to = json.loads(params['reply_parameters']).get('message_id')
+        elif 'reply_to_message_id' in params:
+            reply_to = int(params['reply_to_message_id'])
+        if reply_to is not None:
+            self.first_replies.setdefault((chat_id, reply_to), time.monotonic())
+        return self.message(chat_id, message_id, params['text'])
+
+    def message(self, chat_id, message_id, text):
+        return {
+            "message_id": message_id,
+            "from": BOT_USER,
+            "chat": self.chat_info(chat_id),
+            "date": int(time.time()),
+            "text": text,
+        }
+
+async def read_params(request):
+    """Reads the parameters of a call, telebot sends a form body even with GET.
+    """
+    params = dict(request.query)
+    if request.content_type == "multipart/form-data":
+        reader = await request.multipart()
+        while (part := await reader.next()) is not None:
+            params[part.name] = await part.text()
+    elif request.can_read_body:
+        params.update(parse_qsl(await request.text()))
+    return params
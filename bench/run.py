@@ -0,0 +1,206 @@
+"""Offline load test of the bot against a fake Telegram and a fake llama.cpp.
+
+    python -m bench.run --groups 20 --topics 2 --privates 20 --messages 500 --rate 20
+
+Synthetic updates go through the real handle_text_message -> generate_answer
+-> complete path. The report gives p50/p99 time to first reply,
+messages/sec, backend requests/sec and memory growth. --max-p99-ms,
+--min-reply-rate and --min-cache-hit-rate make the run exit with 1 when
+they are not met, so it can gate CI.
+"""
+import os
+import io
+import sys
+import json
+import time
+import asyncio
+import shutil
+import argparse
+import tempfile
+import contextlib
+import tracemalloc
+from aiohttp import web
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from bench.fake_llamacpp import FakeLlamaCpp
+from bench.fake_telegram import FakeTelegram
+from bench.traffic import TrafficGenerator, make_chats
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--groups", type=int, default=10)
+    parser.add_argument("--topics", type=int, default=0, help="forum topics per group, 0 for plain groups")
+    parser.add_argument("--privates", type=int, default=10)
+    parser.add_argument("--messages", type=int, default=200)
+    parser.add_argument("--rate", type=float, default=20, help="incoming messages per second")
+    parser.add_argument("--addressed", type=float, default=0.3, help="share of group messages mentioning the bot")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--slots", type=int, default=4, help="slots of the fake llama.cpp server")
+    parser.add_argument("--prefill-ms", type=float, default=0.2, help="fake prefill time per uncached prompt token")
+    parser.add_argument("--decode-ms", type=float, default=10, help="fake decode time per generated token")
+    parser.add_argument("--reply-tokens", type=int, default=24)
+    parser.add_argument("--telegram-ms", type=float, default=0, help="fake Telegram API latency")
+    parser.add_argument("--parallel", type=int, default=None, help="override max_parallel_requests")
+    parser.add_argument("--no-stream", action="store_true", help="disable token streaming")
+    parser.add_argument("--drain-timeout", type=float, default=120)
+    parser.add_argument("--trace-memory", action="store_true", help="measure Python allocations with tracemalloc (slower)")
+    parser.add_argument("--verbose", action="store_true", help="keep the bot output")
+    parser.add_argument("--json", help="also write the report to this file")
+    parser.add_argument("--max-p99-ms", type=float, help="fail when the p99 time to first reply is above this")
+    parser.add_argument("--min-reply-rate", type=float, help="fail when fewer replies/sec are sent")
+    parser.add_argument("--min-cache-hit-rate", type=float, help="fail when the backend prefix cache hit rate is below this")
+    return parser.parse_args(argv)
+
+async def serve(app):
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://127.0.0.1:{port}"
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q / 100 * len(values)))]
+
+def rss_bytes():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+async def run(args):
+    llama = FakeLlamaCpp(args.slots, args.prefill_ms, args.decode_ms, args.reply_tokens)
+    telegram = FakeTelegram(args.telegram_ms)
+    llama_runner, llama_url = await serve(llama.app())
+    telegram_runner, telegram_url = await serve(telegram.app())
+
+    # the bot reads its settings at import time
+    os.environ["TG_TOKEN"] = "123456:bench"
+    from telebot import asyncio_helper
+    from settings import ACTIVE_MODEL
+    asyncio_helper.API_URL = telegram_url + "/bot{0}/{1}"
+    ACTIVE_MODEL.update({
+        "api_url": f"{llama_url}/completion",
+        "backends": None,
+        "tokenize_url": f"{llama_url}/tokenize",
+        "stream": not args.no_stream,
+    })
+    if args.parallel:
+        ACTIVE_MODEL['max_parallel_requests'] = args.parallel
+
+    cwd = os.getcwd()
+    workdir = tempfile.mkdtemp(prefix="bot-bench-")
+    os.chdir(workdir)
+    try:
+        return await drive(args, llama, telegram)
+    finally:
+        await llama_runner.cleanup()
+        await telegram_runner.cleanup()
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+async def drive(args, llama, telegram):
+    from telebot import types
+    from settings import ACTIVE_PROMPT
+    import bot
+    import logs
+    import inference
+
+    logs.recover()
+    ACTIVE_PROMPT['persona_name'] = (await bot.bot.get_me()).username
+
+    chats = make_chats(args.groups, args.topics, args.privates)
+    generator = TrafficGenerator(chats, args.addressed, args.seed)
+    sent = {} # (chat_id, message_id) -> monotonic time the update was handed to the bot
+
+    if args.trace_memory:
+        tracemalloc.start()
+    rss_before = rss_bytes()
+    traced_before = tracemalloc.get_traced_memory()[0] if args.trace_memory else 0
+
+    output = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+    with output:
+        started = time.monotonic()
+        for delay, update in generator.arrivals(args.rate, args.messages):
+            await asyncio.sleep(delay)
+            message = update['message']
+            sent[(message['chat']['id'], message['message_id'])] = time.monotonic()
+            await bot.bot.process_new_updates([types.Update.de_json(update)])
+        injected = time.monotonic()
+
+        deadline = injected + args.drain_timeout
+        while (bot.SCHEDULER.depth() or bot.SCHEDULER.running or bot.OUTBOX.workers) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        finished = time.monotonic()
+
+        await logs.flush()
+
+    rss_after = rss_bytes()
+    traced_after = tracemalloc.get_traced_memory()[0] if args.trace_memory else 0
+
+    ttfr = [
+        (telegram.first_replies[key] - at) * 1000
+        for key, at in sent.items() if key in telegram.first_replies
+    ]
+    elapsed = finished - started
+    report = {
+        "messages": len(sent),
+        "replies": len(ttfr),
+        "dropped_turns": bot.SCHEDULER.dropped,
+        "coalesced_turns": bot.SCHEDULER.coalesced,
+        "undrained_turns": bot.SCHEDULER.depth() + len(bot.SCHEDULER.running),
+        "elapsed_s": round(elapsed, 3),
+        "ingest_messages_per_s": round(len(sent) / max(injected - started, 1e-9), 2),
+        "replies_per_s": round(len(ttfr) / elapsed, 2),
+        "backend_requests": llama.requests,
+        "backend_requests_per_s": round(llama.requests / elapsed, 2),
+        "backend_prefix_cache_hit_rate": round(llama.cached_tokens / max(llama.prompt_tokens, 1), 3),
+        "ttfr_p50_ms": percentile(ttfr, 50),
+        "ttfr_p99_ms": percentile(ttfr, 99),
+        "telegram_calls": telegram.calls,
+        "outbound_merged": bot.OUTBOX.merged,
+        "outbound_dropped": bot.OUTBOX.dropped,
+        "rss_growth_mb": round((rss_after - rss_before) / 2**20, 2),
+    }
+    if args.trace_memory:
+        report["traced_growth_mb"] = round((traced_after - traced_before) / 2**20, 2)
+
+    await bot.SCHEDULER.close()
+    await bot.OUTBOX.close()
+    await inference.close_session()
+    await logs.close()
+    await bot.bot.close_session()
+    return report
+
+def main(argv=None):
+    args = parse_args(argv)
+    report = asyncio.run(run(args))
+
+    for key, value in report.items():
+        if isinstance(value, float):
+            value = f"{value:.2f}"
+        print(f"{key:32} {value}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+    failures = []
+    if args.max_p99_ms is not None and (report['ttfr_p99_ms'] is None or report['ttfr_p99_ms'] > args.max_p99_ms):
+        failures.append(f"p99 time to first reply {report['ttfr_p99_ms']} ms is above {args.max_p99_ms} ms")
+    if args.min_reply_rate is not None and report['replies_per_s'] < args.min_reply_rate:
+        failures.append(f"{report['replies_per_s']} replies/s is below {args.min_reply_rate}")
+    if args.min_cache_hit_rate is not None and report['backend_prefix_cache_hit_rate'] < args.min_cache_hit_rate:
+        failures.append(f"prefix cache hit rate {report['backend_prefix_cache_hit_rate']} is below {args.min_cache_hit_rate}")
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,72 @@
+"""Synthetic Telegram traffic: groups, forum topics and private chats.
+"""
+import time
+import random
+
+PERSONA = "liberchat_bot"
+WORDS = "the a decentralized model cloud inference what how does someone know aleph libertai token price node run gpu chat is why when".split()
+
+class SyntheticChat:
+    def __init__(self, chat, thread_id=None):
+        self.chat = chat
+        self.thread_id = thread_id
+        self.users = [
+            {"id": 1 + abs(chat['id']) * 10 + i, "is_bot": False, "first_name": f"User{i}", "username": f"user_{abs(chat['id'])}_{i}"}
+            for i in range(5)
+        ]
+
+def make_chats(groups, topics, privates):
+    """Returns the chats of the traffic, `topics` forum topics in each group.
+    """
+    chats = []
+    for i in range(groups):
+        chat = {"id": -1_000_000 - i, "type": "supergroup", "title": f"Group {i}", "is_forum": topics > 0}
+        if topics:
+            chats += [SyntheticChat(chat, thread_id) for thread_id in range(1, topics + 1)]
+        else:
+            chats.append(SyntheticChat(chat))
+    for i in range(privates):
+        user_id = 5_000 + i
+        chats.append(SyntheticChat({"id": user_id, "type": "private", "first_name": "User", "username": f"user{user_id}"}))
+    return chats
+
+class TrafficGenerator:
+    """Builds update dicts with a mix of addressed and ambient messages.
+
+    `addressed` is the share of group messages mentioning the bot, ambient
+    messages are only answered when they happen to contain "bot".
+    """
+    def __init__(self, chats, addressed=0.3, seed=0):
+        self.chats = chats
+        self.addressed = addressed
+        self.random = random.Random(seed)
+        self.update_id = 0
+        self.message_id = 0
+
+    def text(self, chat):
+        words = " ".join(self.random.choice(WORDS) for _ in range(self.random.randint(4, 30)))
+        if chat.chat['type'] != "private" and self.random.random() < self.addressed:
+            return f"@{PERSONA} {words}?"
+        return words
+
+    def next_update(self):
+        chat = self.random.choice(self.chats)
+        self.update_id += 1
+        self.message_id += 1
+        message = {
+            "message_id": self.message_id,
+            "from": self.random.choice(chat.users),
+            "chat": chat.chat,
+            "date": int(time.time()),
+            "text": self.text(chat),
+        }
+        if chat.thread_id is not None:
+            message["message_thread_id"] = chat.thread_id
+            message["is_topic_message"] = True
+        return {"update_id": self.update_id, "message": message}
+
+    def arrivals(self, rate, count):
+        """Yields (delay, update) pairs with Poisson arrivals at `rate` messages/sec.
+        """
+        for _ in range(count):
+            yield self.random.expovariate(rate), self.next_update()
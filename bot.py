@@ -1,21 +1,35 @@
 import re
 import os
+import sys
 import json
 import requests
 import telebot
+import time
 import asyncio
+from contextlib import aclosing
 from telebot.async_telebot import AsyncTeleBot
-from functools import cache
+from functools import cache, partial
+from itertools import islice
 from telebot import types
 from dotenv import load_dotenv
 
-from logs import recover as recover_logs, save as save_logs, HISTORIES
-from inference import complete, prepare_prompt
-from settings import ACTIVE_MODEL, ACTIVE_PROMPT, COMMANDS_DICT
+from logs import recover as recover_logs, save as save_logs, close as close_logs, History, HISTORIES
+import logs
+from inference import complete, complete_stream, close_session, prepare_prompt, invalidate_prompt, count_slots, warm as warm_prompt, StopMatcher
+from records import HistoryMessage
+from cache import TTLCache
+from metrics import trace, serve as serve_metrics, PREWARM_SECONDS, PREWARMED_CHATS, TELEGRAM_SEND, TELEGRAM_EDIT, QUEUE_DEPTH, TURNS_DROPPED, OUTBOUND_DEPTH, OUTBOUND_DROPPED, OUTBOUND_MERGED, OUTBOUND_LIMITED, COMMAND_CACHE_HITS, COMMAND_CACHE_MISSES
+from commands import register_commands, parse_command, normalize_args, static_answer, command_prompt, command_key, ResponseCache, STATIC_COMMANDS, CACHEABLE_COMMANDS
+from outbound import Outbox
+from webhook import WebhookServer, check_settings as check_webhook_settings
+from scheduler import Scheduler, PRIORITY_DIRECT, PRIORITY_AMBIENT
+from summaries import Summarizer
+from settings import ACTIVE_MODEL, ACTIVE_PROMPT, BOT_SETTINGS, COMMANDS_DICT
 
 load_dotenv()
 
 TOKEN = os.getenv("TG_TOKEN")
+WEBHOOK_SECRET = os.getenv("TG_WEBHOOK_SECRET")
 bot = AsyncTeleBot(TOKEN)
 
 current_history = {} # Store the current chat history count for each chat
@@ -23,85 +37,204 @@ current_history = {} # Store the current chat history count for each chat
 
 last_read_message = None  # Store the ID of the last processed message
 
+CHAT_CACHE_SIZE = 4096 # Chats whose metadata is kept
+CHAT_CACHE_TTL = 3600 # Seconds before the metadata of a chat is fetched again
+
+SCHEDULER = Scheduler(ACTIVE_MODEL['max_parallel_requests'], ACTIVE_MODEL['max_queued_turns'], ACTIVE_MODEL['max_turn_wait'])
+QUEUE_DEPTH.source = SCHEDULER.depth
+TURNS_DROPPED.source = lambda: SCHEDULER.dropped
+
+OUTBOX = Outbox(
+    BOT_SETTINGS['chat_send_rate'], BOT_SETTINGS['chat_send_burst'],
+    BOT_SETTINGS['group_send_rate'], BOT_SETTINGS['group_send_burst'],
+    BOT_SETTINGS['global_send_rate'], BOT_SETTINGS['global_send_burst'],
+)
+OUTBOUND_DEPTH.source = OUTBOX.depth
+OUTBOUND_DROPPED.source = lambda: OUTBOX.dropped
+OUTBOUND_MERGED.source = lambda: OUTBOX.merged
+OUTBOUND_LIMITED.source = lambda: OUTBOX.limited
+
+COMMAND_CACHE = ResponseCache(BOT_SETTINGS['command_cache_size'], BOT_SETTINGS['command_cache_ttl'], BOT_SETTINGS['command_cache_disk'])
+COMMAND_CACHE_HITS.source = lambda: COMMAND_CACHE.hits
+COMMAND_CACHE_MISSES.source = lambda: COMMAND_CACHE.misses
+COMMANDS_SLOT = "commands" # command prompts share their prefix, and a slot
+prewarm_task = None # loads the slots after a start
+
+# summaries are made when no turn is waiting for the backend
+SUMMARIZER = Summarizer(ACTIVE_MODEL, lambda: not SCHEDULER.depth() and len(SCHEDULER.running) < SCHEDULER.max_in_flight)
+
 SLOTS = {}
-CHATS = {}
+CHATS = TTLCache(CHAT_CACHE_SIZE, CHAT_CACHE_TTL) # chat id -> telebot chat, as returned by get_chat
 """ Example chat message:
 {'content_type': 'text', 'id': 69, 'message_id': 69, 'from_user': {'id': 414434471, 'is_bot': False, 'first_name': 'Moshe', 'username': 'Jonnyjonnyjon', 'last_name': 'Malawach [AlephIM]', 'language_code': 'fr', 'can_join_groups': None, 'can_read_all_group_messages': None, 'supports_inline_queries': None, 'is_premium': True, 'added_to_attachment_menu': None}, 'date': 1699449497, 'chat': {'id': -4050541508, 'type': 'group', 'title': 'me testing shit', 'username': None, 'first_name': None, 'last_name': None, 'is_forum': None, 'photo': None, 'bio': None, 'join_to_send_messages': None, 'join_by_request': None, 'has_private_forwards': None, 'has_restricted_voice_and_video_messages': None, 'description': None, 'invite_link': None, 'pinned_message': None, 'permissions': None, 'slow_mode_delay': None, 'message_auto_delete_time': None, 'has_protected_content': None, 'sticker_set_name': None, 'can_set_sticker_set': None, 'linked_chat_id': None, 'location': None, 'active_usernames': None, 'emoji_status_custom_emoji_id': None, 'has_hidden_members': None, 'has_aggressive_anti_spam_enabled': None, 'emoji_status_expiration_date': None}, 'sender_chat': None, 'forward_from': None, 'forward_from_chat': None, 'forward_from_message_id': None, 'forward_signature': None, 'forward_sender_name': None, 'forward_date': None, 'is_automatic_forward': None, 'reply_to_message': None, 'via_bot': None, 'edit_date': None, 'has_protected_content': None, 'media_group_id': None, 'author_signature': None, 'text': 'what is aleph.im, does someone know?', 'entities': [<telebot.types.MessageEntity object at 0x7f4aa97033d0>], 'caption_entities': None, 'audio': None, 'document': None, 'photo': None, 'sticker': None, 'video': None, 'video_note': None, 'voice': None, 'caption': None, 'contact': None, 'location': None, 'venue': None, 'animation': None, 'dice': None, 'new_chat_member': None, 'new_chat_members': None, 'left_chat_member': None, 'new_chat_title': None, 'new_chat_photo': None, 'delete_chat_photo': None, 'group_chat_created': None, 'supergroup_chat_created': None, 'channel_chat_created': None, 'migrate_to_chat_id': None, 'migrate_from_chat_id': None, 'pinned_message': None, 'invoice': None, 'successful_payment': None, 'connected_website': None, 'reply_markup': None, 'message_thread_id': None, 'is_topic_message': None, 'forum_topic_created': None, 'forum_topic_closed': None, 'forum_topic_reopened': None, 'has_media_spoiler': None, 'forum_topic_edited': None, 'general_forum_topic_hidden': None, 'general_forum_topic_unhidden': None, 'write_access_allowed': None, 'user_shared': None, 'chat_shared': None, 'story': None, 'json': {'message_id': 69, 'from': {'id': 414434471, 'is_bot': False, 'first_name': 'Moshe', 'last_name': 'Malawach [AlephIM]', 'username': 'Jonnyjonnyjon', 'language_code': 'fr', 'is_premium': True}, 'chat': {'id': -4050541508, 'title': 'me testing shit', 'type': 'group', 'all_members_are_administrators': True}, 'date': 1699449497, 'text': 'what is aleph.im, does someone know?', 'entities': [{'offset': 8, 'length': 8, 'type': 'url'}]}}"""
 
 # @cache
 async def get_chat(chat_id):
-    if chat_id in CHATS:
-        return CHATS[chat_id]
+    chat = CHATS.get(chat_id)
+    if chat is not None:
+        return chat
     
-    return await bot.get_chat(chat_id)
+    chat = await bot.get_chat(chat_id)
+    CHATS[chat_id] = chat
+    return chat
+
+@bot.message_handler(content_types=['new_chat_title', 'new_chat_photo', 'delete_chat_photo', 'migrate_to_chat_id', 'migrate_from_chat_id'])
+async def chat_changed(message):
+    # the cached metadata and base prompt of the chat are outdated
+    CHATS.pop(message.chat.id)
+
+def get_chat_key(message):
+    """Returns the history key of a message, topics of a forum have their own.
+    """
+    if message.is_topic_message:
+        return str(message.chat.id) + "_" + str(message.message_thread_id)
+    return str(message.chat.id)
 
 @bot.message_handler(commands=['clear'])
 async def clear_history(message):
-    chat_id = str(message.chat.id)
-    reply = await bot.reply_to(message, "Clearing history.")
-    HISTORIES[chat_id] = []
+    chat_id = get_chat_key(message)
+    reply = await OUTBOX.send(message.chat.id, partial(bot.reply_to, message, "Clearing history."), TELEGRAM_SEND)
+    logs.clear(chat_id)
     current_history[chat_id] = 0
+    if ACTIVE_MODEL['summarize']:
+        await SUMMARIZER.forget(chat_id)
     await save_logs()
     return
 
 @bot.message_handler(content_types=['text'])
 async def handle_text_message(message):
     if message.chat.type in ['group', 'supergroup', 'private']:  # Check if the chat is a group
-        # if message.chat.type == 'private':
-        #     chat = message.chat.id
-        # else:
-        chat = await get_chat(message.chat.id)
+        chat_id = get_chat_key(message)
 
-        chat_id = str(message.chat.id)
-
-        if message.is_topic_message:
-            chat_id = str(message.chat.id) + "_" + str(message.message_thread_id)
         if (chat_id not in HISTORIES):
-            HISTORIES[chat_id] = []
+            HISTORIES[chat_id] = History()
             current_history[chat_id] = 0
         elif chat_id not in current_history:
             # We take the lowest number between 40 and the current history length
             current_history[chat_id] = min(ACTIVE_MODEL['low_message_water'], len(HISTORIES[chat_id]))
+            if ACTIVE_MODEL['summarize']:
+                # what left the window before a restart, if it was not summarized yet
+                SUMMARIZER.add(chat_id, HISTORIES[chat_id][:-current_history[chat_id] or None])
         else:
             # if it's higher than 80, we set to 40
             if current_history[chat_id] > ACTIVE_MODEL['high_message_water']:
+                if ACTIVE_MODEL['summarize']:
+                    SUMMARIZER.add(chat_id, HISTORIES[chat_id][-current_history[chat_id]:-ACTIVE_MODEL['low_message_water']])
                 current_history[chat_id] = ACTIVE_MODEL['low_message_water']
 
 
         if isinstance(message, types.Message):  # Check if it's a real message (ignores edited messages)
-            HISTORIES[chat_id].append(message)
+            record = HistoryMessage.from_message(message)
+            logs.append(chat_id, record)
             current_history[chat_id] += 1
             await save_logs()
+
+            command, args = parse_command(record.text, ACTIVE_PROMPT['persona_name'])
+            if command in STATIC_COMMANDS:
+                await send_answer(message, chat_id, static_answer(command, ACTIVE_PROMPT['persona_name']))
+                return
+            # a command replying to a message is about that message, it needs the chat log
+            if command in CACHEABLE_COMMANDS and args.strip() and message.reply_to_message is None and BOT_SETTINGS['command_cache']:
+                args = normalize_args(command, args)
+                key = command_key(command, args, ACTIVE_MODEL, ACTIVE_PROMPT['persona_name'])
+                answer = await COMMAND_CACHE.get(key)
+                if answer is not None:
+                    trace(chat_id, f"{command} answered from the cache")
+                    await send_answer(message, chat_id, answer)
+                else:
+                    # commands do not depend on the chat, they are not coalesced with its turns
+                    SCHEDULER.submit(f"{chat_id}/{message.message_id}", lambda: answer_command(message, chat_id, command, args, key), PRIORITY_DIRECT)
+                return
            
             # now we can process the message, using our AI model
             # we will use the last history messages as context
             messages = HISTORIES[chat_id][-current_history[chat_id]:]
             # messages = HISTORIES[chat_id][-30:]
-            if chat.type != 'private' and not (await should_answer(messages, ACTIVE_PROMPT, ACTIVE_MODEL)):
+            if message.chat.type != 'private' and not (await should_answer(messages, ACTIVE_PROMPT, ACTIVE_MODEL)):
                 return
-            reply = None
-            async for result in generate_answer(messages, ACTIVE_PROMPT, ACTIVE_MODEL, chat_id=chat_id, chat=chat):
-                got_null = (result.strip('\n').strip().strip('"') == "NULL")
-                if got_null: break
-
-                if reply is None:
-                    reply = await bot.reply_to(message, result)
-                else:
-                    # update the reply
-                    print("updating message")
-                    await bot.edit_message_text(chat_id=message.chat.id, message_id=reply.message_id, text=result)
 
-            if reply is not None:
-                HISTORIES[chat_id].append(reply)
-                current_history[chat_id] += 1
-            await save_logs()
+            if message.chat.type == 'private' or is_addressed(record, ACTIVE_PROMPT):
+                priority = PRIORITY_DIRECT
+            else:
+                priority = PRIORITY_AMBIENT
+            # the scheduler answers once per chat at a time, with the history as it is then
+            SCHEDULER.submit(chat_id, lambda: answer_message(message, chat_id), priority)
             
     else:
-        print(message)
+        trace(message.chat.id, f"ignoring a message from a {message.chat.type} chat")
+
+async def answer_message(message, chat_id):
+    # if message.chat.type == 'private':
+    #     chat = message.chat.id
+    # else:
+    chat = await get_chat(message.chat.id)
+    window = current_history.get(chat_id, 0)
+    messages = HISTORIES[chat_id][-window:] if window else []
+    if not messages:
+        # the chat was cleared while the turn waited
+        return
+    summary = SUMMARIZER.get(chat_id) if ACTIVE_MODEL['summarize'] else None
+
+    reply = None
+    record = None
+    answer = None
+    shown = None
+    last_edit = 0
+    async for result in generate_answer(messages, ACTIVE_PROMPT, ACTIVE_MODEL, chat_id=chat_id, chat=chat, summary=summary):
+        stripped = result.strip('\n').strip().strip('"')
+        got_null = (stripped == "NULL")
+        if got_null: break
+        # a streamed answer could still turn out to be NULL
+        if not stripped or "NULL".startswith(stripped): continue
+        answer = result
+
+        if reply is None:
+            reply = await OUTBOX.send(message.chat.id, partial(bot.reply_to, message, result), TELEGRAM_SEND)
+            shown, last_edit = result, time.monotonic()
+            record = HistoryMessage.from_message(reply)
+            logs.append(chat_id, record)
+            current_history[chat_id] += 1
+        elif result != shown and time.monotonic() - last_edit >= ACTIVE_MODEL['stream_edit_interval']:
+            # update the reply, Telegram refuses an edit that changes nothing
+            edit_reply(reply, result)
+            shown, last_edit = result, time.monotonic()
+
+    if reply is not None and answer != shown:
+        edit_reply(reply, answer)
+
+    if record is not None and record.text != answer:
+        # keep the final text, the reply object only knows the first chunk
+        record.text = answer
+        logs.update(chat_id, record)
+    await save_logs()
+
+def edit_reply(reply, text):
+    # not awaited, the outbox sends only the latest text when edits pile up
+    call = partial(bot.edit_message_text, chat_id=reply.chat.id, message_id=reply.message_id, text=text)
+    OUTBOX.edit(reply.chat.id, reply.message_id, call, TELEGRAM_EDIT)
 
-async def generate_answer(messages, active_prompt, model, chat_id="0", chat=None):
+async def send_answer(message, chat_id, text):
+    reply = await OUTBOX.send(message.chat.id, partial(bot.reply_to, message, text), TELEGRAM_SEND)
+    logs.append(chat_id, HistoryMessage.from_message(reply))
+    current_history[chat_id] += 1
+    await save_logs()
+
+async def answer_command(message, chat_id, command, args, key):
+    prompt = command_prompt(command, args, ACTIVE_MODEL, ACTIVE_PROMPT['persona_name'])
+    answer = None
+    async for result in generate_answer([], ACTIVE_PROMPT, ACTIVE_MODEL, chat_id=COMMANDS_SLOT, prompt=prompt):
+        answer = result
+
+    stripped = (answer or "").strip('\n').strip().strip('"')
+    if not stripped or stripped == "NULL":
+        return
+    await COMMAND_CACHE.set(key, answer)
+    await send_answer(message, chat_id, answer)
+
+async def generate_answer(messages, active_prompt, model, chat_id="0", chat=None, prompt=None, summary=None):
     persona_name = active_prompt['persona_name']
-    prompt = await prepare_prompt(messages, active_prompt, model, chat=chat)
+    if prompt is None:
+        prompt = await prepare_prompt(messages, active_prompt, model, chat=chat, chat_id=chat_id, summary=summary)
 
     is_unfinished = True
     tries = 0
@@ -117,24 +250,38 @@ async def generate_answer(messages, active_prompt, model, chat_id="0", chat=None
     # alternative_stop_sequence_2 = f"{user_name}:"
     # stop_sequences.append(alternative_stop_sequence_2)
 
+    stream = model.get('stream') and model['engine'] == "llamacpp"
+
     while is_unfinished and tries < model['max_tries']:
         tries += 1
-        stopped, last_result = await complete(prompt + compounded_result, model, stop_sequences, chat_id=chat_id)
-        full_result = compounded_result + last_result
-        results = full_result
-        print(results)
-
-        for stop_seq in stop_sequences:
-            results = "|||||".join(results.split(f"\n{stop_seq}"))
-            results = "|||||".join(results.split(f"{stop_seq}"))
-
-        results = results.split("|||||")
-
-        first_message = results[0].rstrip()
+        matcher = StopMatcher(stop_sequences)
+        matcher.feed(compounded_result)
+
+        if stream:
+            stopped, last_result = False, ""
+            async with aclosing(complete_stream(prompt + compounded_result, model, stop_sequences, chat_id=chat_id)) as chunks:
+                async for chunk, stopped in chunks:
+                    if chunk is None:
+                        break
+                    last_result += chunk
+                    visible = matcher.feed(chunk).rstrip()
+                    if matcher.stopped:
+                        break
+                    if visible and not stopped:
+                        yield visible
+        else:
+            stopped, last_result = await complete(prompt + compounded_result, model, stop_sequences, chat_id=chat_id)
+            if last_result is None:
+                # every backend failed, keep what we have
+                stopped, last_result = True, ""
+            matcher.feed(last_result)
+        trace(chat_id, compounded_result + last_result)
+
+        first_message = matcher.result().rstrip()
         compounded_result = first_message
         to_yield = compounded_result
 
-        if stopped or results[1:] or len(last_result) < model['max_length']:
+        if stopped or matcher.stopped or len(last_result) < model['max_length']:
             is_unfinished = False
         else:
             is_unfinished = True
@@ -144,12 +291,12 @@ async def generate_answer(messages, active_prompt, model, chat_id="0", chat=None
 
         yield to_yield
         
+def is_addressed(message, active_prompt):
+    return active_prompt['persona_name'] in message.text or message.reply_to_name == active_prompt['persona_name']
+
 async def basic_answer_checks(messages, active_prompt):
     last_message = messages[-1]
-    if "bot" in last_message.text or active_prompt['persona_name'] in last_message.text:
-        return True
-    
-    if (last_message.reply_to_message is not None) and last_message.reply_to_message.from_user.username == active_prompt['persona_name']:
+    if "bot" in last_message.text or is_addressed(last_message, active_prompt):
         return True
     
     for command in COMMANDS_DICT.keys():
@@ -175,41 +322,135 @@ async def should_answer(messages, active_prompt, model):
     #     return False
 
 @bot.edited_message_handler(content_types=['text'])
-def edit_message(message):
-    for topics, messages in HISTORIES.items():
-        for msg in messages:
-            if msg.message_id == message.message_id:
-                msg.text = message.text
-                break
-    print(message)
-
+async def edit_message(message):
+    chat_id = get_chat_key(message)
+    msg = logs.find(chat_id, message.message_id)
+    if msg is not None:
+        msg.text = message.text
+        logs.update(chat_id, msg)
+        invalidate_prompt(chat_id)
+        await save_logs()
+    trace(chat_id, f"message {message.message_id} edited")
+
+# Telegram does not send deletions to bots, this is for when a source of them exists
 # @bot.deleted_message_handler(content_types=['text'])
-# def delete_message(message):
-#     for topics, messages in HISTORIES.items():
-#         for msg in messages:
-#             if msg.message_id == message.message_id:
-#                 messages.remove(msg)
-#                 break
-#     print(message)
+async def delete_message(chat_id, message_id):
+    msg = logs.find(chat_id, message_id)
+    if msg is None:
+        return
+    # the window only shrinks when the message was in it
+    window = islice(reversed(HISTORIES[chat_id]), current_history.get(chat_id, 0))
+    if any(other is msg for other in window):
+        current_history[chat_id] -= 1
+    logs.delete(chat_id, message_id)
+    invalidate_prompt(chat_id)
+    await save_logs()
 
-async def run_bot():
+async def process_update(data):
+    await bot.process_new_updates([types.Update.de_json(data)])
+
+async def prewarm():
+    """Loads the prompts of the most recently active chats in the llama.cpp slots.
+
+    The first answer in these chats then only pays the prefill of the new
+    message, instead of the base prompt and the whole window.
+    """
+    started = time.monotonic()
+    limit = ACTIVE_MODEL['prewarm_chats'] or await count_slots(ACTIVE_MODEL)
+    if not limit:
+        print("Not prewarming, the number of slots is unknown")
+        return
+    chat_ids = await asyncio.to_thread(logs.recent_chats, limit)
+    semaphore = asyncio.Semaphore(ACTIVE_MODEL['prewarm_concurrency'])
+
+    async def warm(chat_id):
+        async with semaphore:
+            if chat_id in current_history:
+                # a live message got there first
+                return False
+            chat = await get_chat(int(chat_id.split("_")[0]))
+            if chat_id in current_history:
+                return False
+            # the window the next message of the chat will be answered with, without it
+            messages = HISTORIES[chat_id][-ACTIVE_MODEL['low_message_water']:]
+            if not messages:
+                return False
+            summary = SUMMARIZER.get(chat_id) if ACTIVE_MODEL['summarize'] else None
+            # the prompt builder of the chat is locked while a live turn uses it
+            prompt = await prepare_prompt(messages, ACTIVE_PROMPT, ACTIVE_MODEL, add_persona=False, chat=chat, chat_id=chat_id, summary=summary)
+            if chat_id in current_history:
+                return False
+            return await warm_prompt(prompt, ACTIVE_MODEL, chat_id)
+
+    results = await asyncio.gather(*[warm(chat_id) for chat_id in chat_ids], return_exceptions=True)
+    warmed = sum(result is True for result in results)
+    elapsed = time.monotonic() - started
+    PREWARM_SECONDS.set(elapsed)
+    PREWARMED_CHATS.set(warmed)
+    print(f"Prewarmed {warmed} of {len(chat_ids)} chats in {elapsed:.1f}s")
+
+async def start():
+    global prewarm_task
     recover_logs()
     ACTIVE_PROMPT['persona_name'] = (await bot.get_me()).username
+    if ACTIVE_MODEL['prewarm']:
+        # in the background, live messages are not held back by it
+        prewarm_task = asyncio.create_task(prewarm())
+    if BOT_SETTINGS['metrics_port']:
+        return await serve_metrics(BOT_SETTINGS['metrics_host'], BOT_SETTINGS['metrics_port'])
+    return None
+
+async def stop(metrics_runner):
+    if prewarm_task is not None:
+        prewarm_task.cancel()
+        await asyncio.gather(prewarm_task, return_exceptions=True)
+    await SCHEDULER.close()
+    await SUMMARIZER.close()
+    await OUTBOX.close()
+    await close_session()
+    await close_logs()
+    if metrics_runner is not None:
+        await metrics_runner.cleanup()
+
+async def run_bot():
+    if BOT_SETTINGS['mode'] == "webhook":
+        check_webhook_settings(BOT_SETTINGS['webhook_url'], WEBHOOK_SECRET)
+    metrics_runner = await start()
 
     # use the commands dict to set the commands for the bot
-    await bot.set_my_commands([
-        types.BotCommand(command[1:].split(' ')[0], description)
-        for command, description in COMMANDS_DICT.items()
-    ], scope=types.BotCommandScopeAllPrivateChats())
-
-    await bot.set_my_commands([
-        types.BotCommand(command[1:].split(' ')[0], description)
-        for command, description in COMMANDS_DICT.items()
-    ], scope=types.BotCommandScopeAllGroupChats())
+    await register_commands(bot)
     
-    await bot.polling()
+    webhook = None
+    try:
+        if BOT_SETTINGS['mode'] == "webhook":
+            webhook = WebhookServer(process_update, BOT_SETTINGS['webhook_path'], WEBHOOK_SECRET, BOT_SETTINGS['webhook_queue_size'])
+            await webhook.start(BOT_SETTINGS['webhook_host'], BOT_SETTINGS['webhook_port'])
+            await bot.set_webhook(url=BOT_SETTINGS['webhook_url'], secret_token=WEBHOOK_SECRET)
+            await asyncio.Event().wait()
+        else:
+            await bot.delete_webhook()
+            await bot.polling()
+    finally:
+        if webhook is not None:
+            await webhook.stop()
+        await stop(metrics_runner)
+
+async def run_worker(updates):
+    """Handles the updates of a shard, read from a multiprocessing queue until None.
+    """
+    metrics_runner = await start()
+    try:
+        while (data := await asyncio.to_thread(updates.get)) is not None:
+            try:
+                await process_update(data)
+            except Exception as e:
+                print(f"Error: could not process update {data.get('update_id')}: {e}")
+    finally:
+        await stop(metrics_runner)
+        await bot.close_session()
     
 if __name__ == '__main__':
+    if BOT_SETTINGS['workers'] > 1:
+        sys.exit("The chats are sharded across several workers, start the bot with: python sharding.py")
 
-    asyncio.run(run_bot())
-    save_logs()
\ No newline at end of file
+    asyncio.run(run_bot())
\ No newline at end of file
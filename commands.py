@@ -0,0 +1,96 @@
+import re
+import json
+import time
+import asyncio
+import hashlib
+from telebot import types
+
+import storage
+from cache import TTLCache
+from settings import COMMANDS_DICT, INFO
+
+STATIC_COMMANDS = {"/help", "/info"} # answered without the model
+CACHEABLE_COMMANDS = {"/define", "/urban", "/translate"} # answered from their arguments alone
+CASE_INSENSITIVE_COMMANDS = {"/define", "/urban"}
+
+COMMAND_PATTERN = re.compile(r"(/\w+)(?:@(\w+))?(?:\s+(.*))?", re.S)
+
+async def register_commands(bot):
+    """Sets the commands of the settings as the bot commands, in private and group chats.
+    """
+    commands = [
+        types.BotCommand(command[1:].split(' ')[0], description)
+        for command, description in COMMANDS_DICT.items()
+    ]
+    await bot.set_my_commands(commands, scope=types.BotCommandScopeAllPrivateChats())
+    await bot.set_my_commands(commands, scope=types.BotCommandScopeAllGroupChats())
+
+def parse_command(text, persona_name):
+    """Splits a command message into the command and its arguments.
+
+    Returns (None, None) for other messages and for commands sent to another bot.
+    """
+    match = COMMAND_PATTERN.fullmatch(text.strip())
+    if match is None:
+        return None, None
+    command, mention, args = match.groups()
+    if mention is not None and mention.lower() != persona_name.lower():
+        return None, None
+    return command.lower(), args or ""
+
+def normalize_args(command, args):
+    args = " ".join(args.split())
+    if command in CASE_INSENSITIVE_COMMANDS:
+        args = args.casefold()
+    return args
+
+def static_answer(command, persona_name):
+    if command == "/help":
+        return "Available commands:\n" + "\n".join(f"{command} - {description}" for command, description in COMMANDS_DICT.items())
+    if command == "/info":
+        return INFO.replace("{{char}}", persona_name)
+    return None
+
+def command_prompt(command, args, model, persona_name):
+    """Returns a prompt made of the command alone, without the chat log.
+    """
+    base_prompt = model['command_base_prompt'].replace("{{char}}", persona_name)
+    line = f"{model['user_prepend']}user{model['user_append']}{command} {args}"
+    return f"{base_prompt}\n{model['log_start']}\n{model['line_separator']}{line}\n{model['line_separator']}{model['user_prepend']}{persona_name} (in reply to user){model['user_append']}"
+
+def command_key(command, args, model, persona_name):
+    """Returns the cache key of a command, the model settings that change the answer included.
+    """
+    settings = [
+        command, args, persona_name, model['name'], model['command_base_prompt'], model['temperature'],
+        model['top_p'], model['top_k'], model['max_length'], model['max_tries'], model['stop_sequences'],
+    ]
+    return hashlib.sha256(json.dumps(settings).encode()).hexdigest()
+
+class ResponseCache:
+    """Answers to the cacheable commands, in memory and optionally in the database.
+    """
+    def __init__(self, maxsize, ttl, disk=False):
+        self.memory = TTLCache(maxsize, ttl)
+        self.ttl = ttl
+        self.disk = disk
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, key):
+        answer = self.memory.get(key)
+        if answer is None and self.disk:
+            answer = await asyncio.to_thread(storage.read_response, key, time.time())
+            if answer is not None:
+                self.memory[key] = answer
+        if answer is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return answer
+
+    async def set(self, key, answer):
+        self.memory[key] = answer
+        if self.disk:
+            now = time.time()
+            await asyncio.to_thread(storage.write_response, key, answer, now + self.ttl, now)
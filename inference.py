@@ -1,21 +1,114 @@
+import re
+import json
+import time
+import asyncio
 import requests
 import aiohttp
+from contextlib import aclosing
+from tokens import get_token_counter, TOKEN_COUNTERS
+from slots import SlotManager
+from cache import TTLCache
+from metrics import trace, observe_timings, PROMPT_BUILD, PROMPT_TOKENS, BACKEND_REQUEST, BACKEND_RETRIES, BACKEND_FAILURES, SLOT_CACHE_HIT
+from backends import get_backend_pool, BACKEND_POOLS
 
-SLOTS = {}
+REQUEST_TIMEOUT = aiohttp.ClientTimeout(total=300, sock_read=60)
 
-def calculate_number_of_tokens(line):
-    return len(line) / 2.7
+class PromptBuilder:
+    """Formatted chat log lines of a chat window, with their token counts.
 
-def get_user_name(user):
-    return user.username or ((user.first_name or "") + " " + (user.last_name or ""))
+    Lines are only formatted and counted when a message enters the window or
+    gets edited, and a running token total is kept as the window slides, so
+    building a prompt is a single join in the common case.
+    """
+    def __init__(self, model):
+        self.model = model
+        self.counter = get_token_counter(model)
+        self.entries = [] # (message_id, text, chunk, tokens) for each message of the window
+        self.total_tokens = 0
+        self.last_tokens = 0 # tokens of the last built chat log
+        self.lock = asyncio.Lock() # sync awaits the token counts, one sync and build at a time
 
-async def prepare_prompt(messages, active_prompt, model, add_persona=True, chat=None):
-    chat_log = ""
-    current_tokens = 0
-    persona_name = active_prompt['persona_name']
+    def format_line(self, msg):
+        return format_line(msg, self.model)
+
+    def invalidate(self):
+        self.entries = []
+        self.total_tokens = 0
+
+    async def sync(self, messages):
+        """Aligns the cached lines with the messages of the window.
+        """
+        entries = self.entries
+
+        # drop the lines that slid out of the front of the window
+        start = 0
+        if messages:
+            first_id = messages[0].message_id
+            while start < len(entries) and entries[start][0] != first_id:
+                start += 1
+        dropped = entries[:start]
+        kept = entries[start:]
+
+        # keep the lines that still match, the first difference invalidates the rest
+        same = 0
+        while same < len(kept) and same < len(messages) \
+                and kept[same][0] == messages[same].message_id and kept[same][1] == messages[same].text:
+            same += 1
+        dropped += kept[same:]
+        del kept[same:]
+
+        self.total_tokens -= sum(entry[3] for entry in dropped)
+        added = messages[same:]
+        lines = [self.format_line(msg) for msg in added]
+        # one await for all the new lines, after a restart the whole window is new
+        counts = await self.counter.count_many(lines)
+        for msg, line, tokens in zip(added, lines, counts):
+            kept.append((msg.message_id, msg.text, f"{self.model['line_separator']}{line}\n", tokens))
+            self.total_tokens += tokens
+        self.entries = kept
+
+    def build(self, max_tokens):
+        """Returns the chat log made of the most recent lines that fit in max_tokens.
+        """
+        if self.total_tokens <= max_tokens:
+            self.last_tokens = self.total_tokens
+            return "".join(entry[2] for entry in self.entries)
+
+        current_tokens = 0
+        start = len(self.entries)
+        for entry in reversed(self.entries):
+            if (current_tokens + entry[3]) > max_tokens:
+                break
+            current_tokens += entry[3]
+            start -= 1
+        self.last_tokens = current_tokens
+        return "".join(entry[2] for entry in self.entries[start:])
+
+def format_line(msg, model):
+    if (msg.reply_to_name is not None):
+        return f"{model['user_prepend']}{msg.name} (in reply to {msg.reply_to_name}){model['user_append']}{msg.text}"
+    return f"{model['user_prepend']}{msg.name}{model['user_append']}{msg.text}"
+
+PROMPT_BUILDERS = TTLCache(4096, 24 * 3600) # chat_id -> PromptBuilder
+
+def get_prompt_builder(chat_id, model):
+    builder = PROMPT_BUILDERS.get(chat_id)
+    if builder is None or builder.model is not model:
+        builder = PromptBuilder(model)
+        if chat_id is not None:
+            PROMPT_BUILDERS[chat_id] = builder
+    return builder
+
+BASE_PROMPTS = TTLCache(4096, 24 * 3600) # chat id -> (chat, model name, persona name, base prompt, prompt calc)
+
+def render_base_prompt(chat, model, persona_name):
+    """Returns the base prompt of a chat, rendered once per chat object.
 
-    if chat is None:
-        chat = messages[-1].chat
+    A refreshed chat object from the chat cache renders it again.
+    """
+    cached = BASE_PROMPTS.get(chat.id)
+    if cached is not None and cached[0] is chat and cached[1] == model['name'] and cached[2] == persona_name:
+        return cached[3], cached[4]
 
     if chat.type == "private":
         base_prompt = model['private_base_prompt'].replace("{{char}}", persona_name)\
@@ -28,57 +121,47 @@ async def prepare_prompt(messages, active_prompt, model, add_persona=True, chat=
             .replace("{{room_title}}", chat.title or "")\
             .replace("{{room_description}}", chat.description or "")
     prompt_calc = f"{base_prompt}\n{model['log_start']}\n{model['user_prepend']}{persona_name}{model['user_append']}"
-    initial_prompt_tokens = calculate_number_of_tokens(prompt_calc)
+    BASE_PROMPTS[chat.id] = chat, model['name'], persona_name, base_prompt, prompt_calc
+    return base_prompt, prompt_calc
+
+def invalidate_prompt(chat_id):
+    """Drops the cached lines of a chat, after one of its messages changed.
+    """
+    builder = PROMPT_BUILDERS.get(chat_id)
+    if builder is not None:
+        builder.invalidate()
+
+async def prepare_prompt(messages, active_prompt, model, add_persona=True, chat=None, chat_id=None, summary=None):
+    with PROMPT_BUILD.time() as timer:
+        prompt = await build_prompt(messages, active_prompt, model, add_persona, chat, chat_id, summary)
+    trace(chat_id, f"prompt built in {timer.elapsed * 1000:.1f}ms")
+    return prompt
+
+async def build_prompt(messages, active_prompt, model, add_persona, chat, chat_id, summary):
+    persona_name = active_prompt['persona_name']
+
+    base_prompt, prompt_calc = render_base_prompt(chat, model, persona_name)
+    builder = get_prompt_builder(chat_id, model)
+    initial_prompt_tokens = await builder.counter.count(prompt_calc)
+
+    # the summary of the messages that left the window comes before the recent lines
+    summary_block = ""
+    if summary:
+        summary_block = f"{model['line_separator']}{model['summary_start']}{summary}\n"
+        initial_prompt_tokens += await builder.counter.count(summary_block)
     max_tokens = model['max_tokens'] - initial_prompt_tokens
 
-    chat_log_lines = []
-    seen_info = set()
-
-    for msg in messages:
-        name = get_user_name(msg.from_user)
-        # check if the message is from our telegram bot
-        # if name == bot.get_me().username:
-        #     name = persona_name
-        # if name == active_prompt.users[0].username:
-        #     name = user_name
-        # elif name == active_prompt.users[1].username:
-        #     name = persona_name
-        if (msg.reply_to_message is not None):
-            chat_log_lines.append(f"{model['user_prepend']}{name} (in reply to {get_user_name(msg.reply_to_message.from_user)}){model['user_append']}{msg.text}")
-        else:
-            chat_log_lines.append(f"{model['user_prepend']}{name}{model['user_append']}{msg.text}")
-
-    for line in reversed(chat_log_lines):
-        line_tokens = calculate_number_of_tokens(line)
-
-        # matched_entries = find_matches(line)
-        # info_tokens = 0
-        # info_text = ''
-        # for entry in matched_entries:
-        #     if entry not in seen_info:
-        #         formatted_entry = f"### INFO: {entry}"
-        #         info_tokens += calculate_number_of_tokens(formatted_entry)
-        #         info_text += f"{formatted_entry}\n"
-        #         seen_info.add(entry)
-
-        if (current_tokens + line_tokens) <= max_tokens:
-            chat_log = f"{model['line_separator']}{line}\n{chat_log}"
-            current_tokens += line_tokens
-
-            # if info_text:
-            #     print("adding info text", info_text)
-            #     chat_log = f"{info_text}{chat_log}"
-            #     current_tokens += info_tokens
-        else:
-            break
-    
+    async with builder.lock:
+        await builder.sync(messages)
+        chat_log = builder.build(max_tokens)
+    PROMPT_TOKENS.observe(initial_prompt_tokens + builder.last_tokens)
+
     if add_persona:
-        return f"{base_prompt}\n{model['log_start']}\n{chat_log}{model['line_separator']}{model['user_prepend']}{persona_name} (in reply to {get_user_name(messages[-1].from_user)}){model['user_append']}"
+        return f"{base_prompt}\n{model['log_start']}\n{summary_block}{chat_log}{model['line_separator']}{model['user_prepend']}{persona_name} (in reply to {messages[-1].name}){model['user_append']}"
     else:
-        return f"{base_prompt}\n{model['log_start']}\n{chat_log}{model['line_separator']}"
+        return f"{base_prompt}\n{model['log_start']}\n{summary_block}{chat_log}{model['line_separator']}"
 
-async def complete(prompt, model, stop_sequences, length=None, chat_id="0"):
-    print(prompt)
+def get_params(prompt, model, stop_sequences, length, slot_id):
     params = {
         "prompt": prompt,
         "temperature": model['temperature'],
@@ -86,11 +169,6 @@ async def complete(prompt, model, stop_sequences, length=None, chat_id="0"):
         "top_k": model['top_k'],
     }
 
-    if chat_id in SLOTS:
-        session, slot_id = SLOTS[chat_id]
-    else:
-        session, slot_id = aiohttp.ClientSession(), -1
-
     if model['engine'] == "kobold":
         params.update({
             "n": 1,
@@ -108,7 +186,6 @@ async def complete(prompt, model, stop_sequences, length=None, chat_id="0"):
             "use_default_badwordsids": False
         })
     elif model['engine'] == "llamacpp":
-        print("slot_id", slot_id)
         # slot_id = model['slot_id'] is None and -1 or model['slot_id']
         params.update({
             "n_predict": length is None and model['max_length'] or length,
@@ -126,34 +203,244 @@ async def complete(prompt, model, stop_sequences, length=None, chat_id="0"):
             "stop": stop_sequences,
             "max_tokens": length is None and model['max_length'] or length,
         })
+    return params
+
+SESSION = None
+SLOT_MANAGERS = {} # api_url -> SlotManager
 
-    async with session.post(model['api_url'], json=params) as response:
+async def get_session():
+    global SESSION
+    if SESSION is None:
+        SESSION = aiohttp.ClientSession()
+    return SESSION
 
-        if response.status == 200:
-            # Simulate the response (you will need to replace this with actual API response handling)
-            response_data = await response.json()
+async def get_slot_manager(model, session):
+    manager = SLOT_MANAGERS.get(model['api_url'])
+    if manager is None:
+        manager = SLOT_MANAGERS[model['api_url']] = SlotManager(model['api_url'])
+    if model['engine'] == "llamacpp":
+        await manager.load(session)
+    return manager
 
-            if model['engine'] == "kobold":
-                print(response_data)
-                return_data = False, response_data['results'][0]['text']
+async def count_slots(model):
+    """Returns the number of slots this process may use across the backends of the model, 0 if unknown.
+    """
+    session = await get_session()
+    managers = [await get_slot_manager(backend.model, session) for backend in get_backend_pool(model).backends]
+    return sum(len(manager.slots) for manager in managers if manager.n_slots is not None)
 
-            elif model['engine'] == "llamacpp":
-                # model['slot_id'] = response_data['slot_id']
-                if 'slot_id' in response_data:
-                    slot_id = response_data['slot_id']
-                elif 'id_slot' in response_data:
-                    slot_id = response_data['id_slot']
-                    
-                stopped = response_data['stopped_eos'] or response_data['stopped_word']
-                return_data = stopped, response_data['content']
+async def close_session():
+    global SESSION
+    for pool in BACKEND_POOLS.values():
+        await pool.close()
+    for counter in TOKEN_COUNTERS.values():
+        await counter.close()
+    if SESSION is not None:
+        await SESSION.close()
+        SESSION = None
 
-            elif model['engine'] == "openai":
-                return_data = False, response_data.choices[0]['text']
-            
-            SLOTS[chat_id] = session, slot_id
+def report_cache_hit(manager, chat_id, hit_rate):
+    if hit_rate is not None:
+        SLOT_CACHE_HIT.observe(hit_rate)
+        trace(chat_id, f"prefix cache hit rate {hit_rate:.0%} (overall {manager.hit_rate():.0%})")
 
-            return return_data
+async def complete(prompt, model, stop_sequences, length=None, chat_id="0"):
+    """Runs a completion on the backend pool of the model.
+
+    A failed request is retried with the same prompt on the next best backend.
+    Returns (stopped, content), content is None when every backend failed.
+    """
+    trace(chat_id, prompt)
+
+    session = await get_session()
+    pool = get_backend_pool(model)
+    pool.start(session)
+    tried = []
+    while (backend := pool.route(chat_id, exclude=tried)) is not None:
+        if tried:
+            BACKEND_RETRIES.inc()
+        tried.append(backend)
+        result = await complete_on(backend, session, prompt, stop_sequences, length, chat_id)
+        if result is not None:
+            return result
+    return True, None
+
+async def warm(prompt, model, chat_id):
+    """Loads a prompt in the slot of the chat without generating anything.
+
+    Only llama.cpp backends keep the prompt, returns False when none took it.
+    """
+    session = await get_session()
+    pool = get_backend_pool(model)
+    pool.start(session)
+    others = [backend for backend in pool.backends if backend.model['engine'] != "llamacpp"]
+    backend = pool.route(chat_id, exclude=others)
+    if backend is None:
+        return False
+    return await complete_on(backend, session, prompt, [], 0, chat_id) is not None
+
+async def complete_on(backend, session, prompt, stop_sequences, length, chat_id):
+    model = backend.model
+    manager = await get_slot_manager(model, session)
+    slot_id = manager.acquire(chat_id)
+    trace(chat_id, f"request on slot {slot_id} of {model['api_url']}")
+    response_data = None
+    return_data = None
+
+    params = get_params(prompt, model, stop_sequences, length, slot_id)
+
+    backend.in_flight += 1
+    started = time.monotonic()
+    try:
+        async with session.post(model['api_url'], json=params, timeout=REQUEST_TIMEOUT) as response:
+
+            if response.status == 200:
+                # Simulate the response (you will need to replace this with actual API response handling)
+                response_data = await response.json()
+
+                if model['engine'] == "kobold":
+                    trace(chat_id, response_data)
+                    return_data = False, response_data['results'][0]['text']
+
+                elif model['engine'] == "llamacpp":
+                    # model['slot_id'] = response_data['slot_id']
+                    stopped = response_data['stopped_eos'] or response_data['stopped_word']
+                    return_data = stopped, response_data['content']
+
+                elif model['engine'] == "openai":
+                    return_data = False, response_data['choices'][0]['text']
+            else:
+                print(f"Error: Request to {model['api_url']} failed with status code {response.status}")
+    except (aiohttp.ClientError, asyncio.TimeoutError, KeyError, ValueError) as e:
+        print(f"Error: Request to {model['api_url']} failed: {e!r}")
+    finally:
+        backend.in_flight -= 1
+        BACKEND_REQUEST.observe(time.monotonic() - started)
+        if model['engine'] == "llamacpp":
+            observe_timings(response_data)
+            report_cache_hit(manager, chat_id, manager.release(chat_id, slot_id, response_data))
         else:
-            print(f"Error: Request failed with status code {response.status}")
-            return True, None
+            manager.release(chat_id, slot_id)
+
+    if return_data is None:
+        BACKEND_FAILURES.inc()
+        backend.failed()
+    else:
+        backend.succeeded(time.monotonic() - started)
+    return return_data
+
+async def complete_stream(prompt, model, stop_sequences, length=None, chat_id="0"):
+    """Streams a completion, yielding (content, stopped) for each chunk.
+
+    Uses the server-sent events of the llama.cpp `stream: true` mode, `stopped`
+    is only set on the last event. Other engines yield their whole answer at
+    once. A backend failing before the first chunk is replaced by the next
+    best one, a single (None, True) is yielded when every backend failed.
+    """
+    trace(chat_id, prompt)
+
+    session = await get_session()
+    pool = get_backend_pool(model)
+    pool.start(session)
+    tried = []
+    while (backend := pool.route(chat_id, exclude=tried)) is not None:
+        if tried:
+            BACKEND_RETRIES.inc()
+        tried.append(backend)
+        if backend.model['engine'] != "llamacpp":
+            result = await complete_on(backend, session, prompt, stop_sequences, length, chat_id)
+            if result is not None:
+                yield result[1], result[0]
+                return
+            continue
+
+        started = False
+        async with aclosing(stream_on(backend, session, prompt, stop_sequences, length, chat_id)) as chunks:
+            async for chunk, stopped in chunks:
+                if chunk is None:
+                    break
+                started = True
+                yield chunk, stopped
+        if started:
+            return
+    yield None, True
+
+async def stream_on(backend, session, prompt, stop_sequences, length, chat_id):
+    model = backend.model
+    manager = await get_slot_manager(model, session)
+    slot_id = manager.acquire(chat_id)
+    trace(chat_id, f"request on slot {slot_id} of {model['api_url']}")
+    last_event = None
+
+    params = get_params(prompt, model, stop_sequences, length, slot_id)
+    params['stream'] = True
+
+    backend.in_flight += 1
+    started = time.monotonic()
+    try:
+        async with session.post(model['api_url'], json=params, timeout=REQUEST_TIMEOUT) as response:
+            if response.status != 200:
+                print(f"Error: Request to {model['api_url']} failed with status code {response.status}")
+                BACKEND_FAILURES.inc()
+                backend.failed()
+                yield None, True
+                return
+
+            async for line in response.content:
+                line = line.strip()
+                if not line.startswith(b"data: "):
+                    continue
+                event = json.loads(line[len(b"data: "):])
+
+                if last_event is None:
+                    # the latency that matters for a stream is the time to the first token
+                    backend.succeeded(time.monotonic() - started)
+                if event.get('stop'):
+                    last_event = event
+                    yield event.get('content', ""), bool(event.get('stopped_eos') or event.get('stopped_word'))
+                    return
+                last_event = {}
+                yield event.get('content', ""), False
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+        print(f"Error: Request to {model['api_url']} failed: {e!r}")
+        BACKEND_FAILURES.inc()
+        backend.failed()
+        yield None, True
+    finally:
+        backend.in_flight -= 1
+        BACKEND_REQUEST.observe(time.monotonic() - started)
+        observe_timings(last_event)
+        report_cache_hit(manager, chat_id, manager.release(chat_id, slot_id, last_event))
+
+class StopMatcher:
+    """Cuts a growing text at the earliest stop sequence, scanning it only once.
+
+    The tail that could still be the start of a stop sequence is held back
+    until the following chunks settle it.
+    """
+    def __init__(self, stop_sequences):
+        stop_sequences = sorted(set(stop_sequences), key=len, reverse=True)
+        self.pattern = re.compile("|".join(re.escape(seq) for seq in stop_sequences))
+        self.hold = max(len(seq) for seq in stop_sequences) - 1
+        self.text = ""
+        self.scanned = 0 # no stop sequence starts before this offset
+        self.stopped = False
+
+    def feed(self, chunk):
+        """Adds a chunk and returns the text known to come before any stop sequence.
+        """
+        if self.stopped:
+            return self.text
+        self.text += chunk
+        match = self.pattern.search(self.text, self.scanned)
+        if match:
+            self.text = self.text[:match.start()]
+            self.stopped = True
+            return self.text
+        self.scanned = max(self.scanned, len(self.text) - self.hold)
+        return self.text[:self.scanned]
 
+    def result(self):
+        """Returns the whole text once no more chunk will come.
+        """
+        return self.text
@@ -1,13 +1,202 @@
-from storage import read_history, write_history
-HISTORIES = {}
+import asyncio
+from collections import OrderedDict
+
+import storage
+from settings import ACTIVE_MODEL
+from metrics import SAVE_LOGS
+
+SAVE_DELAY = 1.0 # Seconds during which successive saves are coalesced into one write
+
+class History:
+    """The messages of a chat, oldest first, indexed by message id.
+
+    Appending, finding and deleting a message take constant time, indexing
+    and slicing work like on a list of the messages.
+    """
+    def __init__(self, messages=()):
+        self.messages = OrderedDict((message.message_id, message) for message in messages)
+
+    def append(self, message):
+        self.messages[message.message_id] = message
+
+    def get(self, message_id):
+        return self.messages.get(message_id)
+
+    def remove(self, message_id):
+        del self.messages[message_id]
+
+    def trim(self, count):
+        """Drops the oldest messages, keeping the last `count`.
+        """
+        while len(self.messages) > count:
+            self.messages.popitem(last=False)
+
+    def __len__(self):
+        return len(self.messages)
+
+    def __iter__(self):
+        return iter(self.messages.values())
+
+    def __reversed__(self):
+        return reversed(self.messages.values())
+
+    def __getitem__(self, index):
+        return list(self.messages.values())[index]
+
+class LazyHistories(dict):
+    """Chat histories, each loaded from storage the first time it is touched.
+
+    Only the last `high_message_water` messages of a chat are loaded, older
+    messages stay on disk.
+    """
+    def __init__(self):
+        super().__init__()
+        self.stored = set()
+
+    def __missing__(self, chat_id):
+        if chat_id not in self.stored:
+            raise KeyError(chat_id)
+        history = History(storage.read_chat(chat_id, ACTIVE_MODEL['high_message_water']))
+        self[chat_id] = history
+        return history
+
+    def __contains__(self, chat_id):
+        return dict.__contains__(self, chat_id) or chat_id in self.stored
+
+    def get(self, chat_id, default=None):
+        return self[chat_id] if chat_id in self else default
+
+HISTORIES = LazyHistories()
+
+_pending = {} # chat_id -> {message_id: message} waiting to be written
+_cleared = set() # chats whose stored history has to be deleted
+_deleted = set() # (chat_id, message_id) of the messages to delete
+_flush_lock = asyncio.Lock()
+_flush_task = None
 
 def recover():
-    """Recovers the chat history from a file.
+    """Opens the history storage, migrating the old logs.json file if there is one.
+    """
+    storage.migrate()
+    HISTORIES.stored = storage.list_chats()
+
+def recent_chats(limit):
+    """Returns the ids of the stored chats that were active last, most recent first.
+    """
+    return storage.recent_chats(limit)
+
+def append(chat_id, message):
+    """Adds a message to a chat history and queues it for writing.
+    """
+    if chat_id not in HISTORIES:
+        HISTORIES[chat_id] = History()
+    history = HISTORIES[chat_id]
+    history.append(message)
+    _pending.setdefault(chat_id, {})[message.message_id] = message
+
+    # older messages are only needed on disk
+    if len(history) > 2 * ACTIVE_MODEL['high_message_water']:
+        history.trim(ACTIVE_MODEL['high_message_water'])
+
+def find(chat_id, message_id):
+    """Returns the message of a chat history with that id, None if it is not held.
+    """
+    history = HISTORIES.get(chat_id) # loads the chat if it was not touched yet
+    return history.get(message_id) if history is not None else None
+
+def update(chat_id, message):
+    """Queues an edited message of a chat history for writing.
+    """
+    _pending.setdefault(chat_id, {})[message.message_id] = message
+
+def delete(chat_id, message_id):
+    """Removes a message from a chat history, returns it or None if it is not held.
+    """
+    message = find(chat_id, message_id)
+    if message is None:
+        return None
+    HISTORIES[chat_id].remove(message_id)
+    _pending.get(chat_id, {}).pop(message_id, None)
+    _deleted.add((chat_id, message_id))
+    return message
+
+def clear(chat_id):
+    """Empties a chat history.
     """
-    for key, value in  read_history().items():
-        HISTORIES[key] = value
+    HISTORIES[chat_id] = History()
+    _pending[chat_id] = {}
+    _cleared.add(chat_id)
 
 async def save():
-    """Saves the chat history to a file.
+    """Schedules a write of the pending changes.
+
+    Saves requested within SAVE_DELAY of each other end up in a single write.
+    """
+    global _flush_task
+    if _flush_task is None:
+        _flush_task = asyncio.create_task(_delayed_flush())
+
+async def _delayed_flush():
+    global _flush_task
+    await asyncio.sleep(SAVE_DELAY)
+    _flush_task = None
+    try:
+        await flush()
+    except Exception as e:
+        print(f"Error: could not write the history, retrying: {e}")
+        await save()
+
+async def flush():
+    """Writes all the pending changes to storage, off the event loop.
+
+    Only new and edited messages are written. When the write fails the
+    changes are pending again, behind the ones made meanwhile.
+    """
+    async with _flush_lock:
+        pending = {chat_id: messages for chat_id, messages in _pending.items() if messages}
+        clears = set(_cleared)
+        deletes = set(_deleted)
+        _pending.clear()
+        _cleared.clear()
+        _deleted.clear()
+        if not (pending or clears or deletes):
+            return
+
+        upserts = {
+            chat_id: [msg.to_row() for msg in messages.values()]
+            for chat_id, messages in pending.items()
+        }
+        try:
+            with SAVE_LOGS.time():
+                await asyncio.to_thread(storage.write_history, upserts, clears, deletes)
+        except Exception:
+            restore(pending, clears, deletes)
+            raise
+        HISTORIES.stored.update(upserts)
+        HISTORIES.stored.difference_update(clears - set(upserts))
+
+def restore(pending, clears, deletes):
+    """Puts back the changes of a failed write, the changes made since win.
+    """
+    for chat_id, messages in pending.items():
+        if chat_id in _cleared:
+            # cleared again since, the messages are gone
+            continue
+        restored = {
+            message_id: msg for message_id, msg in messages.items()
+            if (chat_id, message_id) not in _deleted
+        }
+        restored.update(_pending.get(chat_id, {}))
+        _pending[chat_id] = restored
+    _cleared.update(clears)
+    _deleted.update(deletes)
+
+async def close():
+    """Cancels any scheduled save and flushes everything, used on shutdown.
     """
-    write_history(HISTORIES)
\ No newline at end of file
+    global _flush_task
+    if _flush_task is not None:
+        _flush_task.cancel()
+        _flush_task = None
+    await flush()
+    storage.close()
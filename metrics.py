@@ -0,0 +1,136 @@
+import time
+import bisect
+from aiohttp import web
+
+from settings import BOT_SETTINGS
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+TOKEN_BUCKETS = (128, 256, 512, 1024, 2048, 4096, 8192, 12288, 16384, 32768)
+RATIO_BUCKETS = (0.1, 0.25, 0.5, 0.75, 0.9, 0.95, 0.99, 1)
+
+REGISTRY = []
+
+class Gauge:
+    """A value that is set, or read from `source` when the metrics are rendered.
+    """
+    type = "gauge"
+
+    def __init__(self, name, help, source=None):
+        self.name = name
+        self.help = help
+        self.source = source
+        self.value = 0
+        REGISTRY.append(self)
+
+    def set(self, value):
+        self.value = value
+
+    def render(self):
+        value = self.source() if self.source is not None else self.value
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}", f"{self.name} {value}"]
+
+class Counter(Gauge):
+    type = "counter"
+
+    def inc(self, amount=1):
+        self.value += amount
+
+class Histogram:
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+        REGISTRY.append(self)
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def time(self):
+        return Timer(self)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{{le="{bound}"}} {cumulative}')
+        lines.append(f'{self.name}_bucket{{le="+Inf"}} {self.count}')
+        lines.append(f"{self.name}_sum {self.sum}")
+        lines.append(f"{self.name}_count {self.count}")
+        return lines
+
+class Timer:
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.started = time.monotonic()
+        return self
+
+    def __exit__(self, *exc):
+        self.elapsed = time.monotonic() - self.started
+        self.histogram.observe(self.elapsed)
+
+PROMPT_BUILD = Histogram("bot_prompt_build_seconds", "Time spent building a prompt")
+PROMPT_TOKENS = Histogram("bot_prompt_tokens", "Estimated tokens of the built prompts", TOKEN_BUCKETS)
+BACKEND_REQUEST = Histogram("bot_backend_request_seconds", "Duration of the inference requests")
+BACKEND_PREFILL = Histogram("bot_backend_prefill_seconds", "Prompt processing time reported by llama.cpp")
+BACKEND_DECODE = Histogram("bot_backend_decode_seconds", "Generation time reported by llama.cpp")
+BACKEND_RETRIES = Counter("bot_backend_retries_total", "Inference requests retried on another backend")
+BACKEND_FAILURES = Counter("bot_backend_failures_total", "Failed inference requests")
+SLOT_CACHE_HIT = Histogram("bot_slot_cache_hit_ratio", "Share of the prompt found in the llama.cpp slot cache", RATIO_BUCKETS)
+TELEGRAM_SEND = Histogram("bot_telegram_send_seconds", "Latency of the Telegram sendMessage calls")
+TELEGRAM_EDIT = Histogram("bot_telegram_edit_seconds", "Latency of the Telegram editMessageText calls")
+SAVE_LOGS = Histogram("bot_save_logs_seconds", "Duration of the history writes")
+QUEUE_DEPTH = Gauge("bot_queue_depth", "Turns waiting for a generation")
+TURNS_DROPPED = Counter("bot_turns_dropped_total", "Turns shed by the scheduler")
+OUTBOUND_DEPTH = Gauge("bot_outbound_depth", "Telegram sends and edits waiting for the rate limits")
+OUTBOUND_DROPPED = Counter("bot_outbound_dropped_total", "Telegram sends and edits given up on")
+OUTBOUND_MERGED = Counter("bot_outbound_merged_total", "Pending edits replaced by a later edit of the same message")
+OUTBOUND_LIMITED = Counter("bot_outbound_rate_limited_total", "Telegram calls answered with 429 and retried")
+COMMAND_CACHE_HITS = Counter("bot_command_cache_hits_total", "Commands answered from the response cache")
+COMMAND_CACHE_MISSES = Counter("bot_command_cache_misses_total", "Cacheable commands sent to the model")
+SUMMARIES_WRITTEN = Counter("bot_summaries_total", "Rolling chat summaries written")
+PREWARM_SECONDS = Gauge("bot_prewarm_seconds", "Duration of the slot prewarm after the last start")
+PREWARMED_CHATS = Gauge("bot_prewarmed_chats", "Chats whose prompt was loaded in a slot after the last start")
+
+def observe_timings(response_data):
+    """Records the prefill and decode times of a llama.cpp response.
+    """
+    timings = (response_data or {}).get('timings')
+    if timings:
+        if 'prompt_ms' in timings:
+            BACKEND_PREFILL.observe(timings['prompt_ms'] / 1000)
+        if 'predicted_ms' in timings:
+            BACKEND_DECODE.observe(timings['predicted_ms'] / 1000)
+
+def trace(chat_id, text):
+    """Logs a step of the handling of a chat message, when tracing is enabled.
+    """
+    if BOT_SETTINGS['trace']:
+        print(f"[{chat_id}] {text}")
+
+def render():
+    lines = []
+    for metric in REGISTRY:
+        lines += metric.render()
+    return "\n".join(lines) + "\n"
+
+async def handle_metrics(request):
+    return web.Response(body=render().encode(), headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+async def serve(host, port):
+    """Serves the metrics in the Prometheus text format on /metrics.
+    """
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    print(f"Serving metrics on http://{host}:{port}/metrics")
+    return runner
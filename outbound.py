@@ -0,0 +1,153 @@
+import time
+import asyncio
+from collections import deque
+from telebot.asyncio_helper import ApiTelegramException
+
+from cache import TTLCache
+
+BUCKETS_SIZE = 65536 # Chats whose send rate is remembered
+BUCKETS_TTL = 600 # Seconds an idle chat keeps its bucket
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.blocked_until = 0
+
+    def delay(self):
+        """Returns the seconds to wait before a token is available.
+        """
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        wait = (1 - self.tokens) / self.rate if self.tokens < 1 else 0
+        return max(wait, self.blocked_until - now)
+
+    def take(self):
+        self.tokens -= 1
+
+    def block(self, seconds):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+class Operation:
+    __slots__ = ("call", "key", "histogram", "future")
+
+    def __init__(self, call, key, histogram, future):
+        self.call = call
+        self.key = key
+        self.histogram = histogram
+        self.future = future
+
+class Outbox:
+    """Paces the calls to the Telegram API that send or edit messages.
+
+    Calls to a chat run in order, within a token bucket per chat and a global
+    one. Groups, which have negative chat ids, get the slower group rate. A
+    429 blocks the chat for its `retry_after` before the call is tried again.
+    An edit queued while an earlier edit of the same message is still waiting
+    replaces it, so only the latest text is sent.
+    """
+    def __init__(self, chat_rate, chat_burst, group_rate, group_burst, global_rate, global_burst, max_retries=3):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.group_burst = group_burst
+        self.max_retries = max_retries
+        self.bucket = TokenBucket(global_rate, global_burst)
+        self.buckets = TTLCache(BUCKETS_SIZE, BUCKETS_TTL) # chat id -> TokenBucket
+        self.queues = {} # chat id -> deque of operations waiting
+        self.edits = {} # (chat id, message id) -> edit operation not started yet
+        self.workers = {} # chat id -> task running the operations of the chat
+        self.dropped = 0
+        self.merged = 0
+        self.limited = 0
+
+    def send(self, chat_id, call, histogram=None):
+        """Queues `call`, a coroutine function, and returns a future of its result.
+        """
+        return self.submit(chat_id, call, None, histogram)
+
+    def edit(self, chat_id, message_id, call, histogram=None):
+        """Queues an edit of a message, superseding the pending edit of it.
+
+        The future resolves to None when the edit is dropped.
+        """
+        return self.submit(chat_id, call, (chat_id, message_id), histogram)
+
+    def submit(self, chat_id, call, key, histogram):
+        if key is not None and key in self.edits:
+            operation = self.edits[key]
+            operation.call = call
+            self.merged += 1
+            return operation.future
+
+        operation = Operation(call, key, histogram, asyncio.get_running_loop().create_future())
+        if key is not None:
+            self.edits[key] = operation
+        self.queues.setdefault(chat_id, deque()).append(operation)
+        if chat_id not in self.workers:
+            self.workers[chat_id] = asyncio.create_task(self.work(chat_id))
+        return operation.future
+
+    def depth(self):
+        return sum(len(queue) for queue in self.queues.values())
+
+    async def acquire(self, bucket):
+        while (delay := max(bucket.delay(), self.bucket.delay())) > 0:
+            await asyncio.sleep(delay)
+        bucket.take()
+        self.bucket.take()
+
+    async def work(self, chat_id):
+        queue = self.queues[chat_id]
+        try:
+            while queue:
+                operation = queue.popleft()
+                try:
+                    result = await self.run(chat_id, operation)
+                except Exception as e:
+                    self.dropped += 1
+                    print(f"Error: dropping a Telegram call to chat {chat_id}: {e}")
+                    if operation.key is not None:
+                        operation.future.set_result(None)
+                    else:
+                        operation.future.set_exception(e)
+                else:
+                    operation.future.set_result(result)
+        finally:
+            del self.queues[chat_id]
+            del self.workers[chat_id]
+
+    async def run(self, chat_id, operation):
+        bucket = self.buckets.get(chat_id)
+        if bucket is None:
+            if chat_id < 0:
+                bucket = TokenBucket(self.group_rate, self.group_burst)
+            else:
+                bucket = TokenBucket(self.chat_rate, self.chat_burst)
+            self.buckets[chat_id] = bucket
+
+        for attempt in range(self.max_retries + 1):
+            await self.acquire(bucket)
+            if operation.key is not None:
+                # later edits of the message can no longer be merged into this one
+                self.edits.pop(operation.key, None)
+            try:
+                if operation.histogram is None:
+                    return await operation.call()
+                with operation.histogram.time():
+                    return await operation.call()
+            except ApiTelegramException as e:
+                if e.error_code != 429 or attempt == self.max_retries:
+                    raise
+                self.limited += 1
+                retry_after = e.result_json.get('parameters', {}).get('retry_after', 1)
+                bucket.block(retry_after)
+
+    async def close(self):
+        """Waits for the queued calls to be made.
+        """
+        while self.workers:
+            await asyncio.gather(*self.workers.values(), return_exceptions=True)
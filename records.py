@@ -0,0 +1,39 @@
+import sys
+import json
+
+def get_user_name(user):
+    return user.username or ((user.first_name or "") + " " + (user.last_name or ""))
+
+class HistoryMessage:
+    """A chat history entry, keeping only what the prompt needs from a telebot Message.
+
+    Sender names are interned so every message of a user shares the same string.
+    """
+    __slots__ = ("message_id", "name", "reply_to_name", "text", "date")
+
+    def __init__(self, message_id, name, reply_to_name, text, date):
+        self.message_id = message_id
+        self.name = sys.intern(name)
+        self.reply_to_name = reply_to_name and sys.intern(reply_to_name)
+        self.text = text
+        self.date = date
+
+    @classmethod
+    def from_message(cls, message):
+        reply_to_name = None
+        if message.reply_to_message is not None:
+            reply_to_name = get_user_name(message.reply_to_message.from_user)
+        return cls(message.message_id, get_user_name(message.from_user), reply_to_name, message.text or "", message.date)
+
+    def to_row(self):
+        """Serializes the message as a (message_id, date, data) storage row.
+        """
+        return self.message_id, self.date, json.dumps([self.name, self.reply_to_name, self.text])
+
+    @classmethod
+    def from_row(cls, message_id, date, data):
+        name, reply_to_name, text = json.loads(data)
+        return cls(message_id, name, reply_to_name, text, date)
+
+    def __repr__(self):
+        return f"<HistoryMessage {self.message_id} from {self.name!r}>"
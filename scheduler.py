@@ -0,0 +1,117 @@
+import time
+import asyncio
+from collections import deque
+
+PRIORITY_DIRECT = 0 # private chats and messages addressed to the bot
+PRIORITY_AMBIENT = 1 # other group traffic the bot decided to answer
+
+class Turn:
+    __slots__ = ("run", "priority", "queued_at")
+
+    def __init__(self, run, priority):
+        self.run = run
+        self.priority = priority
+        self.queued_at = time.monotonic()
+
+class Scheduler:
+    """Admission control in front of the answer generation.
+
+    Runs at most one turn per chat at a time: a turn submitted while the chat
+    is generating replaces any turn already waiting for that chat, so messages
+    that arrive during a generation are answered together in the next turn.
+    At most `max_in_flight` turns run at once, direct turns are picked before
+    ambient ones, and ambient turns are shed first when more than `max_queued`
+    turns are waiting or when they waited longer than `max_wait` seconds.
+    """
+    def __init__(self, max_in_flight, max_queued, max_wait):
+        self.max_in_flight = max_in_flight
+        self.max_queued = max_queued
+        self.max_wait = max_wait
+        self.queues = [deque(), deque()] # chat ids waiting, one queue per priority
+        self.queued = {} # chat_id -> Turn waiting in the queues
+        self.deferred = {} # chat_id -> Turn submitted while the chat was running
+        self.running = set()
+        self.ready = asyncio.Event()
+        self.workers = []
+        self.dropped = 0
+        self.coalesced = 0
+
+    def submit(self, chat_id, run, priority=PRIORITY_AMBIENT):
+        """Queues `run`, a coroutine function answering the chat.
+        """
+        if not self.workers:
+            self.workers = [asyncio.create_task(self.work()) for _ in range(self.max_in_flight)]
+
+        turn = Turn(run, priority)
+        if chat_id in self.running:
+            if chat_id in self.deferred:
+                self.coalesced += 1
+                turn.priority = min(priority, self.deferred[chat_id].priority)
+            self.deferred[chat_id] = turn
+        else:
+            self.enqueue(chat_id, turn)
+
+    def enqueue(self, chat_id, turn):
+        previous = self.queued.get(chat_id)
+        if previous is not None:
+            self.coalesced += 1
+            turn.queued_at = previous.queued_at
+            if previous.priority <= turn.priority:
+                # keep the place in the queue, only run the latest turn
+                turn.priority = previous.priority
+                self.queued[chat_id] = turn
+                return
+            self.queues[previous.priority].remove(chat_id)
+
+        self.queued[chat_id] = turn
+        self.queues[turn.priority].append(chat_id)
+        self.shed()
+        self.ready.set()
+
+    def shed(self):
+        while len(self.queued) > self.max_queued:
+            queue = self.queues[PRIORITY_AMBIENT] or self.queues[PRIORITY_DIRECT]
+            chat_id = queue.popleft()
+            del self.queued[chat_id]
+            self.dropped += 1
+            print(f"Dropping the queued turn of chat {chat_id}, {len(self.queued)} turns waiting")
+
+    def depth(self):
+        return len(self.queued) + len(self.deferred)
+
+    def next_turn(self):
+        now = time.monotonic()
+        for queue in self.queues:
+            while queue:
+                chat_id = queue.popleft()
+                turn = self.queued.pop(chat_id)
+                if turn.priority == PRIORITY_AMBIENT and now - turn.queued_at > self.max_wait:
+                    self.dropped += 1
+                    print(f"Dropping the stale turn of chat {chat_id}")
+                    continue
+                return chat_id, turn
+        return None, None
+
+    async def work(self):
+        while True:
+            chat_id, turn = self.next_turn()
+            if turn is None:
+                self.ready.clear()
+                await self.ready.wait()
+                continue
+
+            self.running.add(chat_id)
+            try:
+                await turn.run()
+            except Exception as e:
+                print(f"Error: turn of chat {chat_id} failed: {e}")
+            finally:
+                self.running.discard(chat_id)
+                if chat_id in self.deferred:
+                    self.enqueue(chat_id, self.deferred.pop(chat_id))
+
+    async def close(self):
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
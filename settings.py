@@ -14,6 +14,37 @@ COMMANDS = """/start - Start the bot
 /summarize <text> - Summarize a text
 /urban <word> - Get an urban dictionary definition"""
 
+INFO = """I am {{char}}, a decentralized LLM based on open-source models (finetuned from mistral base models), running on libertai.io, an inference platform on top of the aleph.im decentralized cloud.
+Mention me or reply to my messages in a group and I will answer, or talk to me in private. Send /help to see the commands."""
+
+BOT_SETTINGS = {
+    "trace": False, # log each step of the handling of the messages, prompts and answers included
+    "metrics_host": "127.0.0.1",
+    "metrics_port": None, # serve Prometheus metrics on /metrics when set
+
+    "mode": "polling", # "polling" or "webhook"
+    "webhook_url": None, # public https url Telegram posts the updates to, the secret comes from TG_WEBHOOK_SECRET
+    "webhook_host": "0.0.0.0",
+    "webhook_port": 8443,
+    "webhook_path": "/webhook",
+    "webhook_queue_size": 1000, # updates waiting for the handlers before Telegram is told to retry
+
+    # Telegram allows about one message per second in a chat, 20 per minute in groups, and 30 per second overall
+    "chat_send_rate": 1.0, # sends and edits per second in a private chat
+    "chat_send_burst": 3,
+    "group_send_rate": 20 / 60, # sends and edits per second in a group
+    "group_send_burst": 3,
+    "global_send_rate": 30.0,
+    "global_send_burst": 30,
+
+    "command_cache": True, # answer /define, /urban and /translate from their arguments alone and cache the answers
+    "command_cache_size": 1024,
+    "command_cache_ttl": 24 * 3600,
+    "command_cache_disk": False, # also keep the answers in the database, across restarts
+
+    "workers": 1, # worker processes the chats are sharded across, above 1 the bot is started with `python sharding.py`
+}
+
 # Generate the commands dictionary
 COMMANDS_DICT = {
     command.split(" - ")[0]: command.split(" - ")[1]
@@ -38,6 +69,10 @@ Room description: {{room_description}}
 The AI assistant ("{{char}}"), you, is called on all messages, but helps only if there is a need or he is being called.
 You are "{{char}}", a decentralized LLM, based on open-source models (finetuned from mistral base models), running on libertai.io (inference platform on top of the aleph.im decentralized cloud).
 You are very smart and knowledgeable. You will answer concisely, in a cool way while avoiding emojis. You will never remind that you are a large language model.
+Available commands:\n""" + COMMANDS + "\n",
+    "command_base_prompt": """<|im_start|>system
+A user sends a command to "{{char}}", you, a decentralized LLM, based on open-source models, running on libertai.io.
+You are very smart and knowledgeable. You will answer concisely, in a cool way while avoiding emojis. You will never remind that you are a large language model.
 Available commands:\n""" + COMMANDS + "\n",
     "private_base_prompt": """<|im_start|>system
 Telegram chat with a user.
@@ -57,9 +92,27 @@ Available commands:\n""" + COMMANDS + "\n",
     "name": "OpenHermes 2.5 (7B)",
     "api_url": "https://curated.aleph.cloud/vm/a8b6d895cfe757d4bc5db9ba30675b5031fe3189a99a14f13d5210c473220caf/completion",
     "engine": "llamacpp",
+    "backends": None, # list of per-backend overrides such as {"api_url": ..., "engine": ...}, defaults to the api_url above
+    "tokenizer_file": None, # tokenizer.json of the model, needs the tokenizers package
+    "tokenize_url": None, # defaults to the /tokenize endpoint next to a llama.cpp api_url
     "pass_credentials": True,
+    "stream": True, # stream tokens from llama.cpp and edit the reply as they come
+    "stream_edit_interval": 1.0, # minimum seconds between two edits of a streamed reply
 
     "slot_id": None,
+    "max_parallel_requests": 4, # generations running at once across all chats
+    "max_queued_turns": 64, # waiting turns above this are shed, group traffic first
+    "max_turn_wait": 60, # seconds after which a waiting group turn is dropped
     "low_message_water": 40,
-    "high_message_water": 80
+    "high_message_water": 80,
+
+    "summarize": False, # summarize the messages leaving the window when the backend is idle, and prompt with the summary
+    "summary_length": 200, # tokens of a summary
+    "summary_base_prompt": """<|im_start|>system
+You summarize Telegram chat logs. Keep who said what, the facts, the open questions and the decisions needed to follow the conversation, in a few sentences.""",
+    "summary_start": "<|im_start|>system\nSummary of the earlier messages: ",
+
+    "prewarm": True, # load the prompts of the most active chats in the llama.cpp slots after a start
+    "prewarm_chats": None, # defaults to the number of slots
+    "prewarm_concurrency": 2, # prewarm requests running at once, beside the live traffic
 }
\ No newline at end of file
@@ -0,0 +1,274 @@
+"""Runs the bot as one ingest process and several worker processes.
+
+    python sharding.py             start with BOT_SETTINGS['workers'] workers
+    python sharding.py reshard N   move the stored chats to N workers, with the bot stopped
+
+The ingest process receives the updates, by polling or webhook, and routes
+each one to the worker owning its chat, picked by consistent hashing of the
+chat id. The topics of a forum stay with their chat, so its service messages
+and its send rate are handled by the same worker. A worker handles its
+updates in order, so the messages of a chat keep their order, and keeps its
+chats in its own database file.
+"""
+import os
+import re
+import sys
+import glob
+import signal
+import asyncio
+import bisect
+import hashlib
+import sqlite3
+import argparse
+import multiprocessing
+from queue import Full
+from dotenv import load_dotenv
+from telebot import asyncio_helper
+from telebot.async_telebot import AsyncTeleBot
+
+import slots
+import storage
+from commands import register_commands
+from webhook import WebhookServer, check_settings as check_webhook_settings
+from settings import ACTIVE_MODEL, BOT_SETTINGS
+
+DB_FILE = storage.DB_FILE
+DB_PATTERN = re.compile(r"logs(?:\.(\d+)-of-(\d+))?\.db")
+REPLICAS = 256 # Points of each worker on the hash ring
+QUEUE_SIZE = 1000 # Updates waiting for a worker before the ingest waits
+POLL_TIMEOUT = 20
+WATCH_INTERVAL = 1
+
+# tables holding per chat rows, moved between the databases when resharding
+SHARDED_TABLES = {
+    "messages": ("chat_id", "message_id", "date", "data"),
+    "chats": ("chat_id", "last_date"),
+    "summaries": ("chat_id", "last_message_id", "text"),
+}
+
+def hash_key(key):
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+class HashRing:
+    """Consistent hashing of the chats over the workers.
+
+    Going from n to n + 1 workers only moves about 1 / (n + 1) of the chats.
+    """
+    def __init__(self, shards, replicas=REPLICAS):
+        points = sorted((hash_key(f"{shard}:{replica}"), shard) for shard in range(shards) for replica in range(replicas))
+        self.hashes = [point[0] for point in points]
+        self.shards = [point[1] for point in points]
+
+    def shard(self, key):
+        return self.shards[bisect.bisect(self.hashes, hash_key(key)) % len(self.hashes)]
+
+def update_key(data):
+    """Returns the chat id of an update, the key it is routed by.
+    """
+    message = data.get('message') or data.get('edited_message')
+    if message is None:
+        return ""
+    return str(message['chat']['id'])
+
+def row_key(history_key):
+    """Returns the chat id of a stored history key, topics are stored as chat_thread.
+    """
+    return history_key.split("_")[0]
+
+def db_file(shard, shards):
+    if shards == 1:
+        return DB_FILE
+    return f"logs.{shard}-of-{shards}.db"
+
+def stored_layouts():
+    """Returns the worker counts of the databases found, by their file names.
+    """
+    layouts = set()
+    for path in glob.glob("logs*.db"):
+        match = DB_PATTERN.fullmatch(path)
+        if match is not None:
+            layouts.add(int(match.group(2) or 1))
+    return layouts
+
+def check_layout(shards):
+    others = stored_layouts() - {shards}
+    legacy = os.path.exists(storage.LOGS_FILE)
+    if others or (legacy and shards > 1):
+        sys.exit(f"The stored chats are not sharded for {shards} workers, stop the bot and run: python sharding.py reshard {shards}")
+
+def run_worker(shard, shards, updates):
+    # the ingest stops the workers once it has handed over the updates it received
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    storage.DB_FILE = db_file(shard, shards)
+    slots.SHARD, slots.SHARDS = shard, shards
+    # the limits are shared by the workers
+    ACTIVE_MODEL['max_parallel_requests'] = max(1, ACTIVE_MODEL['max_parallel_requests'] // shards)
+    BOT_SETTINGS['global_send_rate'] /= shards
+    BOT_SETTINGS['global_send_burst'] = max(1, BOT_SETTINGS['global_send_burst'] // shards)
+    if BOT_SETTINGS['metrics_port']:
+        BOT_SETTINGS['metrics_port'] += shard
+
+    import bot # reads the settings at import time
+    asyncio.run(bot.run_worker(updates))
+
+class Ingest:
+    """Routes the updates to the worker processes owning their chats.
+    """
+    def __init__(self, shards):
+        context = multiprocessing.get_context("spawn")
+        self.ring = HashRing(shards)
+        self.queues = [context.Queue(QUEUE_SIZE) for _ in range(shards)]
+        self.workers = [
+            context.Process(target=run_worker, args=(shard, shards, queue), name=f"worker-{shard}")
+            for shard, queue in enumerate(self.queues)
+        ]
+
+    def start(self):
+        for worker in self.workers:
+            worker.start()
+
+    async def dispatch(self, data):
+        shard = self.ring.shard(update_key(data))
+        if not self.workers[shard].is_alive():
+            raise RuntimeError(f"worker {shard} exited with {self.workers[shard].exitcode}")
+        try:
+            self.queues[shard].put_nowait(data)
+        except Full:
+            await asyncio.to_thread(self.queues[shard].put, data)
+
+    async def watch(self):
+        while all(worker.is_alive() for worker in self.workers):
+            await asyncio.sleep(WATCH_INTERVAL)
+        raise RuntimeError("a worker exited")
+
+    async def stop(self):
+        """Lets the workers handle the updates already routed to them, then stops them.
+        """
+        for worker, queue in zip(self.workers, self.queues):
+            if worker.is_alive():
+                await asyncio.to_thread(queue.put, None)
+        for worker in self.workers:
+            await asyncio.to_thread(worker.join)
+
+async def poll(bot, ingest):
+    offset = None
+    try:
+        while True:
+            try:
+                updates = await asyncio_helper.get_updates(bot.token, offset, 100, POLL_TIMEOUT, request_timeout=POLL_TIMEOUT + 10)
+            except Exception as e:
+                print(f"Error: could not get the updates: {e}")
+                await asyncio.sleep(3)
+                continue
+            for data in updates:
+                # a dead worker stops the ingest here, on the first update of its chats
+                await ingest.dispatch(data)
+                offset = data['update_id'] + 1
+    finally:
+        if offset is not None:
+            # confirms the updates handed to the workers, or Telegram sends them again
+            try:
+                await asyncio_helper.get_updates(bot.token, offset, 1, 0)
+            except Exception as e:
+                print(f"Error: could not confirm the updates: {e}")
+
+async def run(shards):
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+    check_layout(shards)
+    load_dotenv()
+    bot = AsyncTeleBot(os.getenv("TG_TOKEN"))
+    secret = os.getenv("TG_WEBHOOK_SECRET")
+    if BOT_SETTINGS['mode'] == "webhook":
+        check_webhook_settings(BOT_SETTINGS['webhook_url'], secret)
+    await register_commands(bot)
+
+    ingest = Ingest(shards)
+    ingest.start()
+    print(f"Started {shards} workers")
+    webhook = None
+    try:
+        if BOT_SETTINGS['mode'] == "webhook":
+            webhook = WebhookServer(ingest.dispatch, BOT_SETTINGS['webhook_path'], secret, BOT_SETTINGS['webhook_queue_size'])
+            await webhook.start(BOT_SETTINGS['webhook_host'], BOT_SETTINGS['webhook_port'])
+            await bot.set_webhook(url=BOT_SETTINGS['webhook_url'], secret_token=secret)
+            await ingest.watch()
+        else:
+            await bot.delete_webhook()
+            await poll(bot, ingest)
+    finally:
+        if webhook is not None:
+            await webhook.stop()
+        await ingest.stop()
+        await bot.close_session()
+
+def copy_rows(source, targets, ring):
+    """Copies the chat rows of a database to the database of their worker.
+    """
+    tables = {row[0] for row in source.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    for table, columns in SHARDED_TABLES.items():
+        if table not in tables:
+            # written before the table existed
+            continue
+        insert = f"INSERT OR REPLACE INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})"
+        cursor = source.execute(f"SELECT {', '.join(columns)} FROM {table}")
+        while rows := cursor.fetchmany(10000):
+            routed = {}
+            for row in rows:
+                routed.setdefault(ring.shard(row_key(row[0])), []).append(row)
+            for shard, shard_rows in routed.items():
+                targets[shard].executemany(insert, shard_rows)
+
+def reshard(shards):
+    """Moves the stored chats to the databases of `shards` workers.
+
+    The old databases are renamed to *.migrated once their rows are copied.
+    """
+    if os.path.exists(storage.LOGS_FILE):
+        storage.DB_FILE = DB_FILE
+        storage.migrate()
+        storage.close()
+
+    sources = [
+        db_file(shard, layout)
+        for layout in sorted(stored_layouts() - {shards})
+        for shard in range(layout)
+        if os.path.exists(db_file(shard, layout))
+    ]
+    if not sources:
+        print(f"The stored chats are already sharded for {shards} workers")
+        return
+
+    ring = HashRing(shards)
+    targets = []
+    for shard in range(shards):
+        connection = sqlite3.connect(db_file(shard, shards))
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.executescript(storage.SCHEMA)
+        targets.append(connection)
+
+    for path in sources:
+        source = sqlite3.connect(path)
+        copy_rows(source, targets, ring)
+        source.close()
+        print(f"Moved the chats of {path}")
+
+    for connection in targets:
+        connection.commit()
+        connection.close()
+    for path in sources:
+        os.rename(path, path + ".migrated")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command")
+    resharding = subparsers.add_parser("reshard", help="move the stored chats to another number of workers")
+    resharding.add_argument("workers", type=int)
+    args = parser.parse_args(argv)
+
+    if args.command == "reshard":
+        reshard(args.workers)
+    else:
+        asyncio.run(run(BOT_SETTINGS['workers']))
+
+if __name__ == '__main__':
+    main()
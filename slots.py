@@ -0,0 +1,134 @@
+import time
+import asyncio
+import aiohttp
+from collections import OrderedDict
+
+# set by the sharded workers, each one uses its share of the slots
+SHARD = 0
+SHARDS = 1
+
+LOAD_RETRY_DELAY = 30 # Seconds before reading the slots again when the server could not be reached
+
+def get_base_url(api_url):
+    if api_url.endswith("/completion"):
+        return api_url[:-len("/completion")]
+    return api_url.rstrip("/")
+
+class SlotManager:
+    """Pins chats to the slots of a llama.cpp server so they keep their KV cache.
+
+    The slot count is read from the /slots or /props endpoint. Each chat keeps
+    its slot while it is active, and when all slots are taken the least recently
+    used chat gives its slot up, preferably one with no request in flight.
+    Without a known slot count the server picks the slot, and the slot it
+    returns is remembered for the chat like before.
+    """
+    def __init__(self, api_url):
+        self.base_url = get_base_url(api_url)
+        self.n_slots = None
+        self.slots = [] # slot ids this process may pin chats to
+        self.loaded = False
+        self.retry_at = 0 # monotonic time of the next read after a failed one
+        self.loading = asyncio.Lock()
+        self.chats = OrderedDict() # chat_id -> slot id, least recently used first
+        self.in_flight = {} # slot id -> requests running on it
+        self.cached_tokens = 0
+        self.prompt_tokens = 0
+
+    async def load(self, session):
+        """Reads the number of slots of the server, once it answered.
+
+        When the server cannot be reached the read is tried again after
+        LOAD_RETRY_DELAY, meanwhile the server picks the slots.
+        """
+        if self.loaded or time.monotonic() < self.retry_at:
+            return
+        async with self.loading:
+            if self.loaded or time.monotonic() < self.retry_at:
+                return
+            try:
+                n_slots = await self.read_slots(session)
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                print(f"Error: could not read the slots of {self.base_url}, retrying in {LOAD_RETRY_DELAY}s: {e}")
+                self.retry_at = time.monotonic() + LOAD_RETRY_DELAY
+                return
+            self.loaded = True
+            if n_slots is not None:
+                self.slots = list(range(SHARD, n_slots, SHARDS))
+                if self.slots:
+                    self.n_slots = n_slots
+                # else more workers than slots, let the server pick
+            print(f"{self.base_url} has {self.n_slots or 'an unknown number of'} slots")
+
+    async def read_slots(self, session):
+        async with session.get(f"{self.base_url}/slots") as response:
+            if response.status == 503:
+                # the server is still loading the model
+                raise aiohttp.ClientError(f"{response.status} {response.reason}")
+            if response.status == 200:
+                slots = await response.json()
+                if isinstance(slots, list) and slots:
+                    return len(slots)
+        async with session.get(f"{self.base_url}/props") as response:
+            if response.status == 200:
+                props = await response.json()
+                return props.get('total_slots') or props.get('default_generation_settings', {}).get('n_slots')
+        return None
+
+    def acquire(self, chat_id):
+        """Returns the slot to use for a request of the chat.
+        """
+        if chat_id in self.chats:
+            self.chats.move_to_end(chat_id)
+            slot_id = self.chats[chat_id]
+        elif self.n_slots is None:
+            slot_id = -1
+        else:
+            taken = set(self.chats.values())
+            free = [slot for slot in self.slots if slot not in taken]
+            if free:
+                slot_id = free[0]
+            else:
+                evicted = next(
+                    (chat for chat, slot in self.chats.items() if not self.in_flight.get(slot)),
+                    next(iter(self.chats))
+                )
+                slot_id = self.chats.pop(evicted)
+            self.chats[chat_id] = slot_id
+
+        self.in_flight[slot_id] = self.in_flight.get(slot_id, 0) + 1
+        return slot_id
+
+    def release(self, chat_id, slot_id, response_data=None):
+        """Records the end of a request, with the final llama.cpp response if any.
+
+        Returns the prefix cache hit rate of the request, or None if unknown.
+        """
+        self.in_flight[slot_id] -= 1
+        if not response_data:
+            return None
+
+        returned_slot = response_data.get('id_slot', response_data.get('slot_id'))
+        if self.n_slots is None and returned_slot is not None and returned_slot >= 0:
+            self.chats[chat_id] = returned_slot
+
+        prompt_tokens = response_data.get('tokens_evaluated')
+        timings = response_data.get('timings') or {}
+        if prompt_tokens and 'prompt_n' in timings:
+            cached = max(prompt_tokens - timings['prompt_n'], 0)
+        elif 'tokens_cached' in response_data and prompt_tokens:
+            cached = min(response_data['tokens_cached'], prompt_tokens)
+        else:
+            return None
+
+        self.cached_tokens += cached
+        self.prompt_tokens += prompt_tokens
+        return cached / prompt_tokens
+
+    def hit_rate(self):
+        """Returns the prefix cache hit rate over all the requests so far.
+        """
+        return self.prompt_tokens and self.cached_tokens / self.prompt_tokens
+
+    def forget(self, chat_id):
+        self.chats.pop(chat_id, None)
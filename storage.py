@@ -1,29 +1,192 @@
+import os
 import json
+import sqlite3
+import threading
 from telebot import types
+from records import HistoryMessage
 
+DB_FILE = "logs.db"
 LOGS_FILE = "logs.json"
 
-def write_history(histories):
-    """Writes the chat history to a file as a json object.
+_connection = None
+_lock = threading.Lock() # the connection is shared between the event loop and the writer thread
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    chat_id TEXT NOT NULL,
+    message_id INTEGER NOT NULL,
+    date INTEGER,
+    data TEXT NOT NULL,
+    PRIMARY KEY (chat_id, message_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS chats (
+    chat_id TEXT PRIMARY KEY,
+    last_date INTEGER
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS chats_last_date ON chats (last_date);
+CREATE TABLE IF NOT EXISTS summaries (
+    chat_id TEXT PRIMARY KEY,
+    last_message_id INTEGER NOT NULL,
+    text TEXT NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS responses (
+    key TEXT PRIMARY KEY,
+    answer TEXT NOT NULL,
+    expires_at REAL NOT NULL
+) WITHOUT ROWID;
+"""
+
+def connect():
+    """Opens the history database, creating it if needed.
     """
-    to_write = {}
-    for chat_id, history in histories.items():
-        to_write[str(chat_id)] = [msg.json for msg in history]
-    with open(LOGS_FILE, "w") as f:
-        json.dump(to_write, f)
+    global _connection
+    if _connection is None:
+        _connection = sqlite3.connect(DB_FILE, check_same_thread=False)
+        _connection.execute("PRAGMA journal_mode=WAL")
+        _connection.execute("PRAGMA synchronous=NORMAL")
+        _connection.executescript(SCHEMA)
+        if _connection.execute("SELECT 1 FROM chats LIMIT 1").fetchone() is None:
+            # written before the chats table, listed once from the messages
+            with _connection:
+                _connection.execute("INSERT OR IGNORE INTO chats (chat_id, last_date) SELECT chat_id, MAX(date) FROM messages GROUP BY chat_id")
+    return _connection
+
+def close():
+    """Closes the history database.
+    """
+    global _connection
+    with _lock:
+        if _connection is not None:
+            _connection.close()
+            _connection = None
+
+def list_chats():
+    """Returns the ids of all the chats that have a stored history.
+    """
+    with _lock:
+        rows = connect().execute("SELECT chat_id FROM chats").fetchall()
+    return {row[0] for row in rows}
+
+def recent_chats(limit):
+    """Returns the ids of the `limit` chats with the latest messages, most recent first.
+    """
+    with _lock:
+        rows = connect().execute(
+            "SELECT chat_id FROM chats ORDER BY last_date DESC LIMIT ?", (limit,)
+        ).fetchall()
+    return [row[0] for row in rows]
+
+def read_chat(chat_id, limit):
+    """Reads the last `limit` messages of a chat, oldest first.
+    """
+    with _lock:
+        rows = connect().execute(
+            "SELECT message_id, date, data FROM messages WHERE chat_id = ? ORDER BY message_id DESC LIMIT ?",
+            (chat_id, limit)
+        ).fetchall()
+    return [HistoryMessage.from_row(*row) for row in reversed(rows)]
+
+def write_history(upserts, clears=(), deletes=()):
+    """Writes new and edited messages in a single transaction.
+
+    `upserts` maps a chat id to a list of (message_id, date, data) rows, chats in
+    `clears` have their stored history deleted before the rows are written and
+    `deletes` holds the (chat_id, message_id) of single messages to delete.
+    """
+    with _lock:
+        connection = connect()
+        with connection:
+            connection.executemany(
+                "DELETE FROM messages WHERE chat_id = ?",
+                [(chat_id,) for chat_id in clears]
+            )
+            connection.executemany(
+                "DELETE FROM chats WHERE chat_id = ?",
+                [(chat_id,) for chat_id in clears]
+            )
+            connection.executemany(
+                "INSERT INTO chats (chat_id, last_date) VALUES (?, ?) "
+                "ON CONFLICT (chat_id) DO UPDATE SET last_date = MAX(COALESCE(last_date, 0), excluded.last_date)",
+                [(chat_id, max(row[1] or 0 for row in rows)) for chat_id, rows in upserts.items() if rows]
+            )
+            connection.executemany(
+                "DELETE FROM messages WHERE chat_id = ? AND message_id = ?",
+                list(deletes)
+            )
+            connection.executemany(
+                "INSERT OR REPLACE INTO messages (chat_id, message_id, date, data) VALUES (?, ?, ?, ?)",
+                [(chat_id, *row) for chat_id, rows in upserts.items() for row in rows]
+            )
 
-def read_history():
-    """Reads the chat history from a file as a json object.
+def read_summary(chat_id):
+    """Returns the (last_message_id, text) of the summary of a chat, None if it has none.
+    """
+    with _lock:
+        return connect().execute(
+            "SELECT last_message_id, text FROM summaries WHERE chat_id = ?", (chat_id,)
+        ).fetchone()
+
+def write_summary(chat_id, last_message_id, text):
+    """Stores the summary of a chat, deletes it when text is None.
+    """
+    with _lock:
+        connection = connect()
+        with connection:
+            if text is None:
+                connection.execute("DELETE FROM summaries WHERE chat_id = ?", (chat_id,))
+            else:
+                connection.execute(
+                    "INSERT OR REPLACE INTO summaries (chat_id, last_message_id, text) VALUES (?, ?, ?)",
+                    (chat_id, last_message_id, text)
+                )
+
+def read_response(key, now):
+    """Returns the cached answer to a command, None when missing or expired.
+    """
+    with _lock:
+        row = connect().execute(
+            "SELECT answer FROM responses WHERE key = ? AND expires_at > ?", (key, now)
+        ).fetchone()
+    return row[0] if row else None
+
+def write_response(key, answer, expires_at, now):
+    """Stores the answer to a command and drops the expired ones.
+    """
+    with _lock:
+        connection = connect()
+        with connection:
+            connection.execute("DELETE FROM responses WHERE expires_at <= ?", (now,))
+            connection.execute(
+                "INSERT OR REPLACE INTO responses (key, answer, expires_at) VALUES (?, ?, ?)",
+                (key, answer, expires_at)
+            )
+
+def read_legacy_history():
+    """Reads the chat history from the logs.json file.
     """
     try:
-        histories = {}
         with open(LOGS_FILE, "r") as f:
-            histories = json.load(f)
-            for chat_id in histories.keys():
-                print(chat_id, len(histories[chat_id]))
-                histories[chat_id] = [
-                    types.Message.de_json(item) for item in histories[chat_id]
-                ]
-        return histories
+            return json.load(f)
     except FileNotFoundError:
-        return {}
\ No newline at end of file
+        return {}
+
+def migrate():
+    """Imports the logs.json history into the database, once.
+
+    The file is renamed afterwards so it is never imported twice.
+    """
+    histories = read_legacy_history()
+    if not histories:
+        return
+
+    write_history({
+        str(chat_id): [
+            HistoryMessage.from_message(types.Message.de_json(item)).to_row()
+            for item in history
+        ]
+        for chat_id, history in histories.items()
+    })
+    for chat_id, history in histories.items():
+        print(chat_id, len(history))
+
+    os.replace(LOGS_FILE, f"{LOGS_FILE}.migrated")
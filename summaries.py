@@ -0,0 +1,151 @@
+import asyncio
+
+import storage
+from inference import complete, format_line, StopMatcher
+from tokens import get_token_counter
+from metrics import trace, SUMMARIES_WRITTEN
+
+IDLE_CHECK_INTERVAL = 1 # Seconds between two checks of whether the backend is idle
+RETRY_DELAY = 60 # Seconds before summarizing again after the backend failed
+SUMMARY_SLOT = "summaries" # summary requests share a slot instead of evicting chats
+PENDING_LIMIT = 400 # Messages kept per chat while the backend is busy, the oldest are dropped
+MAX_FAILURES = 3 # Failed summaries of the same messages before they are dropped
+
+class Summarizer:
+    """Folds the messages leaving the window of a chat into a rolling summary.
+
+    The summaries are made in the background, one chat at a time and only while
+    `idle()` says the backend has nothing better to do. Each one rewrites the
+    previous summary of the chat together with the newly dropped messages, so a
+    summary stays about `summary_length` tokens however long the chat gets.
+    Messages that do not fit in the context are left for the next summary.
+    """
+    def __init__(self, model, idle):
+        self.model = model
+        self.idle = idle
+        self.summaries = {} # chat_id -> (last_message_id, text) or None, loaded on first use
+        self.pending = {} # chat_id -> messages waiting to be summarized
+        self.generations = {} # chat_id -> number of times the chat was cleared
+        self.failures = {} # chat_id -> failed summaries of its oldest pending messages
+        self.ready = asyncio.Event()
+        self.worker = None
+
+    def load(self, chat_id):
+        if chat_id not in self.summaries:
+            self.summaries[chat_id] = storage.read_summary(chat_id)
+        return self.summaries[chat_id]
+
+    def get(self, chat_id):
+        """Returns the summary of a chat, None if it has none yet.
+        """
+        summary = self.load(chat_id)
+        return summary[1] if summary else None
+
+    def add(self, chat_id, messages):
+        """Queues messages that left the window of a chat, those already summarized are skipped.
+        """
+        summary = self.load(chat_id)
+        last_message_id = summary[0] if summary else None
+        pending = self.pending.setdefault(chat_id, [])
+        if pending:
+            last_message_id = pending[-1].message_id
+        pending += [msg for msg in messages if last_message_id is None or msg.message_id > last_message_id]
+        del pending[:-PENDING_LIMIT]
+        if not pending:
+            del self.pending[chat_id]
+            return
+
+        if self.worker is None:
+            self.worker = asyncio.create_task(self.work())
+        self.ready.set()
+
+    async def forget(self, chat_id):
+        """Drops the summary of a cleared chat.
+        """
+        self.pending.pop(chat_id, None)
+        self.failures.pop(chat_id, None)
+        self.summaries[chat_id] = None
+        self.generations[chat_id] = self.generations.get(chat_id, 0) + 1
+        await asyncio.to_thread(storage.write_summary, chat_id, None, None)
+
+    async def prompt(self, summary, messages):
+        """Returns the prompt summarizing the oldest messages that fit in the context, and those messages.
+        """
+        model = self.model
+        earlier = f"\nSummary of the earlier messages: {summary}" if summary else ""
+        head = f"{model['summary_base_prompt']}{earlier}\n"
+        tail = f"{model['line_separator']}{model['user_prepend']}summary{model['user_append']}"
+        counter = get_token_counter(model)
+        budget = model['max_tokens'] - model['summary_length'] - await counter.count(head) - await counter.count(tail)
+
+        lines = [format_line(msg, model) for msg in messages]
+        counts = await counter.count_many(lines)
+        # at least one message, a longer one fails and is dropped after MAX_FAILURES
+        end, tokens = 1, counts[0]
+        while end < len(lines) and tokens + counts[end] <= budget:
+            tokens += counts[end]
+            end += 1
+
+        chat_log = "".join(f"{model['line_separator']}{line}\n" for line in lines[:end])
+        return f"{head}{chat_log}{tail}", messages[:end]
+
+    async def summarize(self, chat_id, prompt, messages, generation):
+        """Returns False when the backend failed.
+        """
+        stop_sequences = [*self.model['stop_sequences'], self.model['user_prepend']]
+        stopped, text = await complete(prompt, self.model, stop_sequences, length=self.model['summary_length'], chat_id=SUMMARY_SLOT)
+        if text is None:
+            return False
+
+        matcher = StopMatcher(stop_sequences)
+        matcher.feed(text)
+        text = matcher.result().strip()
+        if not text or self.generations.get(chat_id, 0) != generation:
+            # nothing came out, or the chat was cleared meanwhile
+            return True
+
+        last_message_id = messages[-1].message_id
+        self.summaries[chat_id] = (last_message_id, text)
+        await asyncio.to_thread(storage.write_summary, chat_id, last_message_id, text)
+        SUMMARIES_WRITTEN.inc()
+        trace(chat_id, f"summarized {len(messages)} messages: {text}")
+        return True
+
+    async def work(self):
+        while True:
+            await self.ready.wait()
+            while self.pending:
+                if not self.idle():
+                    await asyncio.sleep(IDLE_CHECK_INTERVAL)
+                    continue
+                chat_id = next(iter(self.pending))
+                generation = self.generations.get(chat_id, 0)
+                prompt, messages = await self.prompt(self.get(chat_id), self.pending[chat_id])
+                if self.generations.get(chat_id, 0) != generation:
+                    # the chat was cleared meanwhile
+                    continue
+                # the rest waits for the next summary, after the other chats
+                last_message_id = messages[-1].message_id
+                rest = [msg for msg in self.pending.pop(chat_id) if msg.message_id > last_message_id]
+                if rest:
+                    self.pending[chat_id] = rest
+
+                if await self.summarize(chat_id, prompt, messages, generation):
+                    self.failures.pop(chat_id, None)
+                    continue
+                failures = self.failures.get(chat_id, 0) + 1
+                if failures >= MAX_FAILURES:
+                    print(f"Error: dropping {len(messages)} messages of chat {chat_id}, they could not be summarized {failures} times")
+                    self.failures.pop(chat_id, None)
+                elif self.generations.get(chat_id, 0) == generation:
+                    self.failures[chat_id] = failures
+                    # keep them for later, in front of what was dropped meanwhile
+                    self.pending[chat_id] = (messages + self.pending.pop(chat_id, []))[-PENDING_LIMIT:]
+                await asyncio.sleep(RETRY_DELAY)
+            self.ready.clear()
+
+    async def close(self):
+        if self.worker is not None:
+            self.worker.cancel()
+            await asyncio.gather(self.worker, return_exceptions=True)
+            self.worker = None
@@ -0,0 +1,44 @@
+"""A turn still waiting in the scheduler when /clear runs must not answer."""
+import os
+import sys
+import asyncio
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# the bot reads its token at import time
+os.environ.setdefault("TG_TOKEN", "123456:test")
+
+import bot
+import logs
+from records import HistoryMessage
+
+async def get_chat(chat_id):
+    return SimpleNamespace(id=chat_id, type="group", title="test", description="")
+
+async def fail(*args, **kwargs):
+    raise AssertionError("answered an empty window")
+    yield
+
+def answer_after_clear(chat_id):
+    message = SimpleNamespace(chat=SimpleNamespace(id=int(chat_id)), message_id=3)
+    original = bot.get_chat, bot.generate_answer
+    bot.get_chat, bot.generate_answer = get_chat, fail
+    try:
+        asyncio.run(bot.answer_message(message, chat_id))
+    finally:
+        bot.get_chat, bot.generate_answer = original
+        logs.HISTORIES.pop(chat_id, None)
+        bot.current_history.pop(chat_id, None)
+
+def test_cleared_chat_is_not_answered():
+    chat_id = "-1001"
+    logs.HISTORIES[chat_id] = logs.History()
+    bot.current_history[chat_id] = 0
+    answer_after_clear(chat_id)
+
+def test_empty_window_is_not_the_whole_history():
+    # [-0:] would be every message of the chat
+    chat_id = "-1002"
+    logs.HISTORIES[chat_id] = logs.History([HistoryMessage(1, "alice", None, "hi", 0), HistoryMessage(2, "bob", None, "yo", 0)])
+    bot.current_history[chat_id] = 0
+    answer_after_clear(chat_id)
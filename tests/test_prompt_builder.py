@@ -0,0 +1,85 @@
+"""The incremental prompt assembly must give the same prompt as building it from scratch."""
+import os
+import sys
+import random
+import asyncio
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import inference
+from inference import build_prompt, format_line, invalidate_prompt, render_base_prompt
+from records import HistoryMessage
+from settings import ACTIVE_MODEL, ACTIVE_PROMPT
+from tokens import calculate_number_of_tokens
+
+NAMES = ["alice", "bob", "carol", "dave"]
+WORDS = ["hi", "ok", "what", "the", "model", "is", "slow", "today", "lol", "?", "pizza", "again"]
+
+def reference_prompt(messages, model, persona_name, chat, summary, add_persona):
+    """The prompt built from scratch, every line formatted and counted again.
+    """
+    base_prompt, prompt_calc = render_base_prompt(chat, model, persona_name)
+    initial_prompt_tokens = calculate_number_of_tokens(prompt_calc)
+    summary_block = ""
+    if summary:
+        summary_block = f"{model['line_separator']}{model['summary_start']}{summary}\n"
+        initial_prompt_tokens += calculate_number_of_tokens(summary_block)
+    max_tokens = model['max_tokens'] - initial_prompt_tokens
+
+    chat_log = ""
+    current_tokens = 0
+    for msg in reversed(messages):
+        line = format_line(msg, model)
+        line_tokens = calculate_number_of_tokens(line)
+        if (current_tokens + line_tokens) > max_tokens:
+            break
+        chat_log = f"{model['line_separator']}{line}\n{chat_log}"
+        current_tokens += line_tokens
+
+    if add_persona:
+        return f"{base_prompt}\n{model['log_start']}\n{summary_block}{chat_log}{model['line_separator']}{model['user_prepend']}{persona_name} (in reply to {messages[-1].name}){model['user_append']}"
+    return f"{base_prompt}\n{model['log_start']}\n{summary_block}{chat_log}{model['line_separator']}"
+
+def random_text(rng):
+    return " ".join(rng.choice(WORDS) for _ in range(rng.randint(1, 30)))
+
+async def check_random_chat(seed):
+    rng = random.Random(seed)
+    # counted with the length heuristic, without a tokenizer or a backend
+    model = dict(ACTIVE_MODEL, name="prompt-builder-test", engine="kobold", tokenizer_file=None, tokenize_url=None,
+                 max_tokens=rng.choice([400, 600, 2048]))
+    persona_name = ACTIVE_PROMPT['persona_name']
+    chat = SimpleNamespace(id=-seed, type="group", title="test", description="a test group")
+    chat_id = str(chat.id)
+
+    history = []
+    message_id = 0
+    for step in range(300):
+        action = rng.random()
+        if action < 0.6 or len(history) < 2:
+            message_id += 1
+            reply_to_name = rng.choice(NAMES) if rng.random() < 0.2 else None
+            history.append(HistoryMessage(message_id, rng.choice(NAMES), reply_to_name, random_text(rng), 0))
+        elif action < 0.8:
+            # an edit, not always followed by an invalidation
+            rng.choice(history[-40:]).text = random_text(rng)
+            if rng.random() < 0.5:
+                invalidate_prompt(chat_id)
+        elif action < 0.9:
+            history.remove(rng.choice(history[-40:]))
+            invalidate_prompt(chat_id)
+        if not history:
+            continue
+
+        window = history[-rng.randint(1, 80):]
+        summary = random_text(rng) if rng.random() < 0.3 else None
+        add_persona = rng.random() < 0.7
+        prompt = await build_prompt(window, ACTIVE_PROMPT, model, add_persona, chat, chat_id, summary)
+        expected = reference_prompt(window, model, persona_name, chat, summary, add_persona)
+        assert prompt == expected, f"seed {seed}, step {step}"
+
+def test_incremental_prompt_matches_full_rebuild():
+    for seed in range(1, 21):
+        asyncio.run(check_random_chat(seed))
+    inference.PROMPT_BUILDERS.clear()
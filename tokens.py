@@ -0,0 +1,102 @@
+import time
+import asyncio
+import aiohttp
+from collections import OrderedDict
+
+try:
+    from tokenizers import Tokenizer
+except ImportError:
+    Tokenizer = None
+
+CACHE_SIZE = 65536 # Lines whose token count is remembered
+REMOTE_RETRY_DELAY = 60 # Seconds before trying the /tokenize endpoint again after a failure
+REMOTE_TIMEOUT = 5 # Seconds to wait for a /tokenize answer
+REMOTE_CONCURRENCY = 16 # /tokenize requests sent at once
+
+def calculate_number_of_tokens(line):
+    return len(line) / 2.7
+
+def get_tokenize_url(model):
+    if model.get('tokenize_url'):
+        return model['tokenize_url']
+    if model['engine'] == "llamacpp" and model['api_url'].endswith("/completion"):
+        return model['api_url'][:-len("/completion")] + "/tokenize"
+    return None
+
+class TokenCounter:
+    """Counts the tokens of a line with the best available method.
+
+    In order of preference: the local tokenizer file of the model (needs the
+    `tokenizers` package), the llama.cpp /tokenize endpoint, then the length
+    heuristic. Exact counts are memoized in a bounded LRU.
+    """
+    def __init__(self, model):
+        self.tokenizer = None
+        if model.get('tokenizer_file'):
+            if Tokenizer is None:
+                print("Warning: the tokenizers package is not installed, ignoring tokenizer_file")
+            else:
+                self.tokenizer = Tokenizer.from_file(model['tokenizer_file'])
+        self.tokenize_url = get_tokenize_url(model)
+        self.remote_failed_at = None
+        self.remote_slots = asyncio.Semaphore(REMOTE_CONCURRENCY)
+        self.session = None
+        self.cache = OrderedDict()
+
+    async def count(self, line):
+        if line in self.cache:
+            self.cache.move_to_end(line)
+            return self.cache[line]
+
+        tokens = self.count_local(line)
+        if tokens is None:
+            tokens = await self.count_remote(line)
+        if tokens is None:
+            return calculate_number_of_tokens(line)
+
+        self.cache[line] = tokens
+        if len(self.cache) > CACHE_SIZE:
+            self.cache.popitem(last=False)
+        return tokens
+
+    async def count_many(self, lines):
+        """Counts the tokens of several lines, the remote counts are requested concurrently.
+        """
+        return await asyncio.gather(*[self.count(line) for line in lines])
+
+    def count_local(self, line):
+        if self.tokenizer is None:
+            return None
+        return len(self.tokenizer.encode(line, add_special_tokens=False).ids)
+
+    async def count_remote(self, line):
+        if self.tokenize_url is None:
+            return None
+        if self.remote_failed_at is not None and time.monotonic() - self.remote_failed_at < REMOTE_RETRY_DELAY:
+            return None
+
+        if self.session is None:
+            self.session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=REMOTE_TIMEOUT))
+        try:
+            async with self.remote_slots, self.session.post(self.tokenize_url, json={"content": line}) as response:
+                if response.status == 200:
+                    self.remote_failed_at = None
+                    return len((await response.json())['tokens'])
+                print(f"Error: tokenize request failed with status code {response.status}")
+        except (aiohttp.ClientError, asyncio.TimeoutError, KeyError, ValueError) as e:
+            print(f"Error: tokenize request failed: {e}")
+        self.remote_failed_at = time.monotonic()
+        return None
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+TOKEN_COUNTERS = {} # model name -> TokenCounter
+
+def get_token_counter(model):
+    counter = TOKEN_COUNTERS.get(model['name'])
+    if counter is None:
+        counter = TOKEN_COUNTERS[model['name']] = TokenCounter(model)
+    return counter
@@ -0,0 +1,88 @@
+import sys
+import hmac
+import asyncio
+from collections import OrderedDict
+from aiohttp import web
+
+SEEN_UPDATES = 10000 # Update ids remembered to drop the ones Telegram delivers twice
+
+def check_settings(url, secret):
+    """Exits unless the webhook has a public url and a secret token.
+
+    Without the secret anyone finding the url could post forged updates, and
+    setting the webhook without a url would remove it.
+    """
+    if not url:
+        sys.exit("BOT_SETTINGS['webhook_url'] must be set in webhook mode")
+    if not secret:
+        sys.exit("TG_WEBHOOK_SECRET must be set in webhook mode")
+
+class WebhookServer:
+    """Receives the updates on an aiohttp webhook instead of long polling.
+
+    Updates are acknowledged as soon as they are queued and handed to the bot
+    handlers in order by a single consumer. The queue is bounded: when it is
+    full Telegram gets a 503 and delivers the update again later.
+    """
+    def __init__(self, process, path, secret, queue_size=1000):
+        self.process = process
+        self.path = path
+        self.secret = secret
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.seen = OrderedDict() # update ids recently queued
+        self.runner = None
+        self.consumer = None
+
+    async def handle(self, request):
+        token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if not hmac.compare_digest(token.encode(), self.secret.encode()):
+            return web.Response(status=401)
+
+        try:
+            data = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+
+        update_id = data.get('update_id')
+        if update_id in self.seen:
+            return web.Response()
+        try:
+            self.queue.put_nowait(data)
+        except asyncio.QueueFull:
+            return web.Response(status=503)
+
+        self.seen[update_id] = True
+        if len(self.seen) > SEEN_UPDATES:
+            self.seen.popitem(last=False)
+        return web.Response()
+
+    async def consume(self):
+        while True:
+            data = await self.queue.get()
+            try:
+                await self.process(data)
+            except Exception as e:
+                print(f"Error: could not process update {data.get('update_id')}: {e}")
+            finally:
+                self.queue.task_done()
+
+    async def start(self, host, port):
+        app = web.Application()
+        app.router.add_post(self.path, self.handle)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, host, port).start()
+        self.consumer = asyncio.create_task(self.consume())
+        print(f"Listening for updates on http://{host}:{port}{self.path}")
+
+    async def stop(self):
+        """Stops accepting updates and processes the ones already queued.
+        """
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+        if self.consumer is not None:
+            await self.queue.join()
+            self.consumer.cancel()
+            await asyncio.gather(self.consumer, return_exceptions=True)
+            self.consumer = None